@@ -1,18 +1,84 @@
-from pymongo import MongoClient
+from pymongo import ASCENDING, DESCENDING, AsyncMongoClient, IndexModel
 from dotenv import load_dotenv
-import os 
+from typing import Dict, List
+import os
 
 load_dotenv()
 
 connection_string = os.getenv("MONGO_CONNECTION_STRING")
-client = MongoClient(connection_string)
+
+# Pool sizing and timeouts (milliseconds), overridable per deployment
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "5"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "60000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "10000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000"))
+
+client = AsyncMongoClient(
+    connection_string,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+    socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+    waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+)
 db = client.finance_app
 users = db.users
 trades = db.trades
+# Leases so only one worker runs a given background job
+locks = db.locks
+
+# Declarative index registry: collection name -> indexes, applied once at
+# startup by ensure_indexes(). Modules that own a collection register its
+# indexes next to its definition.
+INDEXES: Dict[str, List[IndexModel]] = {}
+
+def register_indexes(collection: str, *indexes: IndexModel):
+    INDEXES.setdefault(collection, []).extend(indexes)
 
-def test_connection():
+# Signin/signup look users up by name; the unique index also settles
+# concurrent signups for the same name
+register_indexes("users", IndexModel([("username", ASCENDING)], unique=True))
+# The trade ledger: newest-first pages per user (read backwards for the
+# oldest-first replays), optionally narrowed to one symbol; _id breaks ties
+# between trades with the same timestamp
+register_indexes(
+    "trades",
+    IndexModel([("user_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)]),
+    IndexModel([("user_id", ASCENDING), ("symbol", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)]),
+)
+
+async def ensure_indexes():
+    # Creating an index that already exists is a no-op, so this is safe on every startup
+    for name, indexes in INDEXES.items():
+        try:
+            await db[name].create_indexes(indexes)
+        except Exception as e:
+            print(f"Failed to create indexes on {name}: {e}")
+
+async def test_connection():
     try:
-        client.admin.command('ping')
+        await client.admin.command('ping')
         print("Successfully connected to MongoDB!")
     except Exception as e:
         print(f"Failed to connect to MongoDB: {e}")
+
+async def held_symbols():
+    # Distinct symbols held in any portfolio or watchlist
+    pipeline = [
+        {"$project": {"symbols": {"$concatArrays": [
+            {"$map": {"input": {"$objectToArray": {"$ifNull": ["$portfolio", {}]}}, "as": "p", "in": "$$p.k"}},
+            {"$ifNull": ["$watchlist", []]}
+        ]}}},
+        {"$unwind": "$symbols"},
+        {"$group": {"_id": {"$toUpper": "$symbols"}}}
+    ]
+    cursor = await users.aggregate(pipeline)
+    return [doc["_id"] async for doc in cursor]
+
+async def close_connection():
+    await client.close()
@@ -4,16 +4,32 @@ from fastapi.staticfiles import StaticFiles
 from .routes.auth_routes import router as auth_router
 from .routes.finance_routes import router as finance_router
 from .routes.chatbot_routes import router as chatbot_router
-from .database import test_connection
+from .routes.job_routes import router as job_router
+from .routes.export_routes import router as export_router
+from .database import test_connection, close_connection, ensure_indexes
+from .services.jobs import job_workers
+from .services.market_data import polygon
+from .services.quote_refresher import quote_refresher
+from .services.quote_stream import quote_hub
+from .services.snapshots import snapshot_scheduler
 from contextlib import asynccontextmanager
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    test_connection()
+    await test_connection()
+    await ensure_indexes()
+    quote_refresher.start()
+    job_workers.start()
+    snapshot_scheduler.start()
     yield
     # Shutdown
-    pass
+    await quote_refresher.stop()
+    await quote_hub.stop()
+    await job_workers.stop()
+    await snapshot_scheduler.stop()
+    await polygon.aclose()
+    await close_connection()
 
 app = FastAPI(lifespan=lifespan)
 app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
@@ -24,11 +40,14 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 app.include_router(auth_router, prefix="/api/auth", tags=["auth"])
 app.include_router(finance_router, prefix="/api/stocks", tags=["stocks"])
 app.include_router(chatbot_router, prefix="/api/chat", tags=["chat"])
+app.include_router(job_router, prefix="/api/jobs", tags=["jobs"])
+app.include_router(export_router, prefix="/api/export", tags=["export"])
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,7 +1,9 @@
-from fastapi import APIRouter, HTTPException, Response, Request
+from fastapi import APIRouter, HTTPException, Query, Response, Request
 from ..database import users
 from ..schemas import UserLogin, UserSignup, ProfilePictureUpdate
+from ..services.user_search import search_tokens, search_users, token_update
 from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
 from fastapi import File, UploadFile, Form
 from typing import Optional
 import aiofiles
@@ -14,12 +16,13 @@ router = APIRouter()
 @router.get("/profile/{user_id}")
 async def get_profile(user_id: str):
     try:
-        user = users.find_one({"_id": ObjectId(user_id)})
+        user = await users.find_one({"_id": ObjectId(user_id)})
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
         user["_id"] = str(user["_id"])
         user.pop("password", None)  
+        user.pop("search_tokens", None)
         
         return user
         
@@ -35,7 +38,7 @@ def signout(response: Response):
 @router.post("/signin")
 async def login(user_data: UserLogin, response: Response):
     try:
-        user = users.find_one({"username": user_data.username})
+        user = await users.find_one({"username": user_data.username})
         if not user:
             raise HTTPException(status_code=401, detail="Invalid credentials")
         
@@ -44,6 +47,7 @@ async def login(user_data: UserLogin, response: Response):
         
         user["_id"] = str(user["_id"])
         user.pop("password", None)
+        user.pop("search_tokens", None)
         
         # Set secure cookie with user session
         response.set_cookie(
@@ -68,12 +72,13 @@ async def check_session(request: Request):
         if not session_token:
             raise HTTPException(status_code=401, detail="Not authenticated")
             
-        user = users.find_one({"_id": ObjectId(session_token)})
+        user = await users.find_one({"_id": ObjectId(session_token)})
         if not user:
             raise HTTPException(status_code=401, detail="Invalid session")
             
         user["_id"] = str(user["_id"])
         user.pop("password", None)
+        user.pop("search_tokens", None)
         return user
         
     except Exception as e:
@@ -82,7 +87,7 @@ async def check_session(request: Request):
 @router.post("/signup")
 async def signup(user_data: UserSignup):
     try:
-        if users.find_one({"username": user_data.username}):
+        if await users.find_one({"username": user_data.username}):
             raise HTTPException(status_code=400, detail="Username already exists")
         
             
@@ -127,16 +132,25 @@ async def signup(user_data: UserSignup):
         if "profile_picture" not in user_doc or not user_doc["profile_picture"]:
           user_doc["profile_picture"] = "https://img.daisyui.com/images/stock/photo-1534528741775-53994a69daeb.webp"
         
-        result = users.insert_one(user_doc)
+        user_doc["search_tokens"] = search_tokens(user_doc)
+
+        try:
+            result = await users.insert_one(user_doc)
+        except DuplicateKeyError:
+            # Lost a race with a concurrent signup for the same name
+            raise HTTPException(status_code=400, detail="Username already exists")
         
-        new_user = users.find_one({"_id": result.inserted_id})
+        new_user = await users.find_one({"_id": result.inserted_id})
         new_user["_id"] = str(new_user["_id"])
         new_user.pop("password", None)
+        new_user.pop("search_tokens", None)
         
         
         
         return new_user
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Signup error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -145,7 +159,7 @@ async def signup(user_data: UserSignup):
 @router.get("/watchlist/{user_id}")
 async def get_watchlist(user_id: str):
     try:
-        user = users.find_one({"_id": ObjectId(user_id)})
+        user = await users.find_one({"_id": ObjectId(user_id)})
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         return user.get("watchlist", [])
@@ -160,7 +174,7 @@ async def add_to_watchlist(user_id: str, data: dict):
         if not symbol:
             raise HTTPException(status_code=400, detail="Symbol is required")
         
-        result = users.update_one(
+        result = await users.update_one(
             {"_id": ObjectId(user_id)},
             {"$addToSet": {"watchlist": symbol}}  # addToSet prevents duplicates
         )
@@ -169,7 +183,7 @@ async def add_to_watchlist(user_id: str, data: dict):
             raise HTTPException(status_code=400, detail="Failed to add to watchlist")
         
         # Return updated watchlist
-        user = users.find_one({"_id": ObjectId(user_id)})
+        user = await users.find_one({"_id": ObjectId(user_id)})
         return user.get("watchlist", [])
         
     except Exception as e:
@@ -179,7 +193,7 @@ async def add_to_watchlist(user_id: str, data: dict):
 @router.delete("/watchlist/{user_id}/{symbol}")
 async def remove_from_watchlist(user_id: str, symbol: str):
     try:
-        result = users.update_one(
+        result = await users.update_one(
             {"_id": ObjectId(user_id)},
             {"$pull": {"watchlist": symbol}}
         )
@@ -188,7 +202,7 @@ async def remove_from_watchlist(user_id: str, symbol: str):
             raise HTTPException(status_code=400, detail="Failed to remove from watchlist")
         
         # Return updated watchlist
-        user = users.find_one({"_id": ObjectId(user_id)})
+        user = await users.find_one({"_id": ObjectId(user_id)})
         return user.get("watchlist", [])
         
     except Exception as e:
@@ -199,7 +213,7 @@ async def remove_from_watchlist(user_id: str, symbol: str):
 async def get_goals(user_id: str):
     try:
         print(f"Attempting to fetch goals for user_id: {user_id}")  # Debug log
-        user = users.find_one({"_id": ObjectId(user_id)})
+        user = await users.find_one({"_id": ObjectId(user_id)})
         if not user:
             print(f"User not found: {user_id}")  # Debug log
             raise HTTPException(status_code=404, detail="User not found")
@@ -218,7 +232,7 @@ async def update_goals(user_id: str, data: dict):
         if not isinstance(data.get("goals"), list):
             raise HTTPException(status_code=400, detail="Invalid goals format")
             
-        result = users.update_one(
+        result = await users.update_one(
             {"_id": ObjectId(user_id)},
             {"$set": {"goals": data.get("goals", [])}}
         )
@@ -241,9 +255,11 @@ async def update_profile(user_id: str, updated_data: dict):
             del updated_data["password"]
         if "_id" in updated_data:
             del updated_data["_id"]
+        updated_data.pop("search_tokens", None)
+        updated_data.update(await token_update(user_id, updated_data))
             
         # Update the user document
-        result = users.update_one(
+        result = await users.update_one(
             {"_id": ObjectId(user_id)},
             {"$set": updated_data}
         )
@@ -252,9 +268,10 @@ async def update_profile(user_id: str, updated_data: dict):
             raise HTTPException(status_code=404, detail="User not found")
             
         # Return updated user data
-        user = users.find_one({"_id": ObjectId(user_id)})
+        user = await users.find_one({"_id": ObjectId(user_id)})
         user["_id"] = str(user["_id"])
         user.pop("password", None)
+        user.pop("search_tokens", None)
         
         return user
         
@@ -264,33 +281,24 @@ async def update_profile(user_id: str, updated_data: dict):
 
 
 @router.get("/users")
-async def get_users(skip: int = 0, limit: int = 20, search: str = None):
+async def get_users(cursor: Optional[str] = None, limit: int = Query(20, ge=1, le=100), search: str = None):
+    # Keyset-paged by _id: pass next_cursor back as cursor for the next page
     try:
-        query = {}
-        if search:
-            query = {
-                "$or": [
-                    {"username": {"$regex": search, "$options": "i"}},
-                    {"firstName": {"$regex": search, "$options": "i"}},
-                    {"lastName": {"$regex": search, "$options": "i"}}
-                ]
-            }
-        
-        total = users.count_documents(query)
-        user_list = users.find(query).skip(skip).limit(limit)
+        user_list, total, estimated, next_cursor = await search_users(search, cursor, limit)
         
         # Format users for response
-        formatted_users = []
         for user in user_list:
             user["_id"] = str(user["_id"])
-            user.pop("password", None)
-            formatted_users.append(user)
             
         return {
-            "users": formatted_users,
-            "total": total
+            "users": user_list,
+            "total": total,
+            "total_estimated": estimated,
+            "next_cursor": next_cursor
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error fetching users: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -300,7 +308,7 @@ async def get_users(skip: int = 0, limit: int = 20, search: str = None):
 @router.put("/profile/{user_id}/update-picture")
 async def update_profile_picture(user_id: str, data: ProfilePictureUpdate):
     try:
-        result = users.update_one(
+        result = await users.update_one(
             {"_id": ObjectId(user_id)},
             {"$set": {"profile_picture": str(data.profile_picture)}}
         )
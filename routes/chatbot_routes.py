@@ -1,16 +1,127 @@
 from fastapi import APIRouter, HTTPException
-from typing import Optional, List, Dict
-from backend_files.services.chatbot import ChatGPT
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Optional, List, Dict
+from backend_files.services.cache import CoalescingCache, shared_backend
+from backend_files.services.chatbot import PRIORITY_CHAT, get_chatgpt, llm_dispatcher
+from backend_files.services.jobs import register_handler, submit_job
+from backend_files.routes.job_routes import job_accepted
 from backend_files.schemas import ChatRequest, PortfolioAnalysisRequest, MarketAnalysisRequest, StockAnalysisRequest
 from pydantic import BaseModel
+import asyncio
+import hashlib
+import json
 import logging as logger
+import os
 
 router = APIRouter()
-chatgpt = ChatGPT()
+chatgpt = get_chatgpt()
+
+
+def _sse(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _stream_reply(chunks: AsyncIterator[str]) -> StreamingResponse:
+    # Waits for the first token so an upstream failure still gets an error
+    # status, then forwards the rest as server-sent events as they arrive
+    try:
+        first = await anext(chunks)
+    except StopAsyncIteration:
+        first = ""
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error starting response stream: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Failed to generate analysis: {str(e)}")
+
+    async def events():
+        try:
+            if first:
+                yield _sse("token", {"text": first})
+            async for text in chunks:
+                yield _sse("token", {"text": text})
+            yield _sse("done", {})
+        except Exception as e:
+            logger.error(f"Error during response stream: {str(e)}", exc_info=True)
+            yield _sse("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# Analyses depend only on their inputs, so identical requests (popular symbols
+# at the same prev-day quote) are answered from cache instead of the model
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", "3600"))
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "2000"))
+ANALYSIS_BATCH_MAX_ITEMS = int(os.getenv("ANALYSIS_BATCH_MAX_ITEMS", "50"))
+ANALYSIS_BATCH_CONCURRENCY = int(os.getenv("ANALYSIS_BATCH_CONCURRENCY", "4"))
+analysis_cache = CoalescingCache(
+    "analysis", maxsize=ANALYSIS_CACHE_SIZE, ttl=ANALYSIS_CACHE_TTL, backend=shared_backend("analysis")
+)
+
+
+def _canonical(value):
+    # Rounds prices to cents and folds case/whitespace so equivalent inputs hash the same
+    if isinstance(value, float):
+        return round(value, 2)
+    if isinstance(value, str):
+        return value.strip().lower()
+    if isinstance(value, dict):
+        return {str(k).strip().lower(): _canonical(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return value
+
+
+def _analysis_key(kind: str, **inputs) -> str:
+    canonical = json.dumps({"kind": kind, **_canonical(inputs)}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+async def _once(text: str) -> AsyncIterator[str]:
+    yield text
+
+
+async def _cached_analysis(key: str, prompt: str, stream: bool):
+    # Concurrent identical requests share one model call. A streamed miss
+    # claims the key while it streams, so identical requests arriving
+    # meanwhile wait and get the finished text as one chunk.
+    if not stream:
+        return await analysis_cache.get_or_fetch(
+            key, lambda: chatgpt._get_response(user_message=prompt, chat_history=[])
+        )
+
+    while True:
+        cached = await analysis_cache.lookup(key)
+        if cached is not None:
+            return await _stream_reply(_once(cached))
+        claim = analysis_cache.claim(key)
+        if claim is not None:
+            break
+        # Someone else started the same analysis after our lookup; wait on theirs
+
+    async def tee():
+        parts = []
+        error = RuntimeError("Analysis stream ended early")
+        try:
+            async for text in chatgpt._stream_response(user_message=prompt, chat_history=[]):
+                parts.append(text)
+                yield text
+            error = None
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            await analysis_cache.resolve(key, claim, "".join(parts), error)
+
+    return await _stream_reply(tee())
 
 
 @router.post("/chat")
-async def chatgpt_post(chat_data: ChatRequest):
+async def chatgpt_post(chat_data: ChatRequest, stream: bool = False):
     try:
         logger.info(f"Received chat request with message length: {len(chat_data.message)}")
         
@@ -20,10 +131,18 @@ async def chatgpt_post(chat_data: ChatRequest):
                 detail="Message cannot be empty"
             )
             
+        if stream:
+            return await _stream_reply(chatgpt._stream_response(
+                user_message=chat_data.message,
+                chat_history=chat_data.chat_history,
+                priority=PRIORITY_CHAT
+            ))
+
         logger.info("Calling ChatGPT service...")
         response = await chatgpt._get_response(
             user_message=chat_data.message,
-            chat_history=chat_data.chat_history
+            chat_history=chat_data.chat_history,
+            priority=PRIORITY_CHAT
         )
         
         if not response:
@@ -46,10 +165,8 @@ async def chatgpt_post(chat_data: ChatRequest):
             detail=f"Chat service error: {str(e)}"
         )
 
-@router.post("/analyze/stock")
-async def analyze_stock(data: StockAnalysisRequest):
-    try:
-        prompt = f"""
+def _stock_prompt(data: StockAnalysisRequest) -> str:
+    return f"""
         Provide a comprehensive analysis of {data.symbol} stock with the following data:
         Current Price: ${data.price}
         Daily Change: ${data.change} ({data.percentChange}%)
@@ -64,14 +181,71 @@ async def analyze_stock(data: StockAnalysisRequest):
         Additional metrics: {data.metrics if data.metrics else 'Not provided'}
         Timeframe: {data.timeframe}
         """
-        
-        response = await chatgpt._get_response(user_message=prompt, chat_history=[])
-        return {"analysis": response}
+
+
+def _stock_key(data: StockAnalysisRequest) -> str:
+    return _analysis_key(
+        "stock", symbol=data.symbol, price=data.price, change=data.change,
+        percentChange=data.percentChange, metrics=data.metrics, timeframe=data.timeframe
+    )
+
+
+@router.post("/analyze/stock")
+async def analyze_stock(data: StockAnalysisRequest, stream: bool = False):
+    try:
+        result = await _cached_analysis(_stock_key(data), _stock_prompt(data), stream)
+        if stream:
+            return result
+        return {"analysis": result}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+
+@router.post("/analyze/batch")
+async def analyze_batch(items: List[StockAnalysisRequest]):
+    # Analyses for many symbols in one request, run with bounded parallelism
+    # and streamed back as server-sent "result" events in completion order.
+    # A failed item gets an "error" field instead of failing the batch.
+    if not items:
+        raise HTTPException(status_code=400, detail="At least one item is required")
+    if len(items) > ANALYSIS_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {ANALYSIS_BATCH_MAX_ITEMS} items per batch")
+
+    semaphore = asyncio.Semaphore(ANALYSIS_BATCH_CONCURRENCY)
+
+    async def analyze(index: int, data: StockAnalysisRequest) -> Dict:
+        result = {"index": index, "symbol": data.symbol}
+        try:
+            async with semaphore:
+                result["analysis"] = await _cached_analysis(_stock_key(data), _stock_prompt(data), stream=False)
+        except HTTPException as he:
+            result["error"] = he.detail
+        except Exception as e:
+            logger.error(f"Batch analysis failed for {data.symbol}: {str(e)}")
+            result["error"] = str(e)
+        return result
+
+    async def events():
+        tasks = [asyncio.create_task(analyze(index, data)) for index, data in enumerate(items)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield _sse("result", await next_done)
+            yield _sse("done", {"count": len(items)})
+        finally:
+            # Client went away: stop paying for analyses nobody will read
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.post("/analyze/market")
-async def analyze_market(data: MarketAnalysisRequest):
+async def analyze_market(data: MarketAnalysisRequest, stream: bool = False):
     try:
         prompt = f"""
         Provide a comprehensive market analysis based on the following data:
@@ -90,15 +264,18 @@ async def analyze_market(data: MarketAnalysisRequest):
         5. {data.timeframe} Outlook
         """
         
-        response = await chatgpt._get_response(user_message=prompt, chat_history=[])
-        return {"analysis": response}
+        key = _analysis_key("market", indices=data.indices, trends=data.trends, timeframe=data.timeframe)
+        result = await _cached_analysis(key, prompt, stream)
+        if stream:
+            return result
+        return {"analysis": result}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.post("/analyze/portfolio")
-async def analyze_portfolio(data: PortfolioAnalysisRequest):
-    try:
-        prompt = f"""
+def _portfolio_prompt(data: PortfolioAnalysisRequest) -> str:
+    return f"""
         Provide a comprehensive portfolio analysis based on the following data:
         
         Portfolio Holdings:
@@ -115,14 +292,43 @@ async def analyze_portfolio(data: PortfolioAnalysisRequest):
         4. Rebalancing Recommendations
         5. Optimization Suggestions
         """
+
+
+@router.post("/analyze/portfolio")
+async def analyze_portfolio(data: PortfolioAnalysisRequest, stream: bool = False):
+    try:
+        prompt = _portfolio_prompt(data)
         
+        if stream:
+            return await _stream_reply(chatgpt._stream_response(user_message=prompt, chat_history=[]))
+
         response = await chatgpt._get_response(user_message=prompt, chat_history=[])
         return {"analysis": response}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def _run_portfolio_analysis(params: Dict) -> Dict:
+    prompt = _portfolio_prompt(PortfolioAnalysisRequest(**params))
+    return {"analysis": await chatgpt._get_response(user_message=prompt, chat_history=[])}
+
+register_handler("portfolio_analysis", _run_portfolio_analysis)
+
+
+@router.post("/analyze/portfolio/jobs", status_code=202)
+async def submit_portfolio_analysis(data: PortfolioAnalysisRequest):
+    # Queues the analysis and returns at once; poll the job for the result.
+    # Identical submissions share one job.
+    try:
+        job, _ = await submit_job("portfolio_analysis", data.model_dump())
+        return job_accepted(job)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/analyze/options")
-async def analyze_options(symbol: str, current_price: float, calls: List[Dict], puts: List[Dict]):
+async def analyze_options(symbol: str, current_price: float, calls: List[Dict], puts: List[Dict], stream: bool = False):
     try:
         prompt = f"""
         Provide an options analysis for {symbol} based on the following data:
@@ -143,8 +349,13 @@ async def analyze_options(symbol: str, current_price: float, calls: List[Dict],
         5. Hedge Opportunities
         """
         
-        response = await chatgpt._get_response(user_message=prompt, chat_history=[])
-        return {"analysis": response}
+        key = _analysis_key("options", symbol=symbol, current_price=current_price, calls=calls, puts=puts)
+        result = await _cached_analysis(key, prompt, stream)
+        if stream:
+            return result
+        return {"analysis": result}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -153,7 +364,8 @@ async def get_trading_suggestion(
     symbol: str,
     current_price: float,
     indicators: Dict[str, float],
-    timeframe: str = "short-term"
+    timeframe: str = "short-term",
+    stream: bool = False
 ):
     try:
         prompt = f"""
@@ -173,7 +385,20 @@ async def get_trading_suggestion(
         5. Risk Management Suggestions
         """
         
-        response = await chatgpt._get_response(user_message=prompt, chat_history=[])
-        return {"suggestion": response}
+        key = _analysis_key(
+            "suggestion", symbol=symbol, current_price=current_price, indicators=indicators, timeframe=timeframe
+        )
+        result = await _cached_analysis(key, prompt, stream)
+        if stream:
+            return result
+        return {"suggestion": result}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/dispatcher/stats")
+async def get_dispatcher_stats():
+    # Model-call slots in use, queue depth and wait times in this worker
+    return llm_dispatcher.snapshot_stats()
@@ -0,0 +1,37 @@
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from ..database import users
+from ..services.export import FORMATS, export_stream, parquet_supported
+from bson import ObjectId
+from bson.errors import InvalidId
+
+router = APIRouter()
+
+
+async def _export(dataset: str, user_id: str, fmt: str) -> StreamingResponse:
+    try:
+        exists = await users.find_one({"_id": ObjectId(user_id)}, {"_id": 1})
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid user id")
+    if not exists:
+        raise HTTPException(status_code=404, detail="User not found")
+    if fmt == "parquet" and not parquet_supported():
+        raise HTTPException(status_code=501, detail="Parquet export requires pyarrow")
+
+    return StreamingResponse(
+        export_stream(dataset, user_id, fmt),
+        media_type=FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{dataset}-{user_id}.{fmt}"'}
+    )
+
+
+@router.get("/{user_id}/trades")
+async def export_trades(user_id: str, format: str = Query("ndjson", pattern="^(ndjson|csv|parquet)$")):
+    # Every trade in the ledger, oldest first
+    return await _export("trades", user_id, format)
+
+
+@router.get("/{user_id}/history")
+async def export_history(user_id: str, format: str = Query("ndjson", pattern="^(ndjson|csv|parquet)$")):
+    # Every daily portfolio snapshot, oldest first
+    return await _export("history", user_id, format)
@@ -1,15 +1,30 @@
-from fastapi import APIRouter, HTTPException, Query
-from backend_files.services.chatbot import ChatGPT
+from fastapi import APIRouter, HTTPException, Query, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 from ..database import users, trades
-import requests
+from ..services.bars import bar_dates, daily_bars, resample_weekly
+from ..services.cache import CoalescingCache, cache_stats, normalize_symbol, shared_backend
+from ..services.cost_basis import gain_loss, get_positions
+from ..services.insights import composition_hash, generate_insights, get_insights, schedule_insights
+from ..services.jobs import register_handler, submit_job
+from ..services.market_calendar import is_open, next_open, next_transition, seconds_until
+from ..services.market_data import polygon
+from ..services.performance import performance_series
+from ..services.quote_refresher import quote_refresher
+from ..services.quote_stream import STREAM_HEARTBEAT, quote_hub
+from ..services.quotes import get_quote, get_quotes
+from ..services.sectors import get_sectors
+from ..services.snapshots import get_history
+from ..services.trading import execute_option, execute_stock, list_trades, option_holdings
+import asyncio
+import httpx
+import json
 import os
 from dotenv import load_dotenv
 from bson import ObjectId
 from datetime import datetime, timedelta
-from typing import Dict, List
-from cachetools import TTLCache
+from typing import Dict, List, Optional
 import random
-import yfinance as yf
+from .job_routes import job_accepted
 from ..schemas import OptionTradeRequest, SectorData, PortfolioSummary, StockTrade
 
 load_dotenv(verbose=True) 
@@ -28,47 +43,54 @@ SECTOR_COLORS = {
     "Cash": "#059669"
 }
 
-POLYGON_API_KEY = os.getenv("POLYGON_API_KEY")
-if not POLYGON_API_KEY or POLYGON_API_KEY.strip() == "":
-    raise ValueError("POLYGON_API_KEY not set or is empty.")
+def _market_ttl(key, value) -> float:
+    # Market status only changes at the next open/close; the rest of the
+    # overview (index level, news) refreshes every 5 minutes while open and
+    # at most hourly while closed
+    until_transition = seconds_until(next_transition())
+    if key == "market_status":
+        return until_transition
+    return min(300 if is_open() else 3600, until_transition)
 
-print("Polygon API Key loaded:", POLYGON_API_KEY)  # Debug: Confirm key is loaded
-
-BASE_POLYGON_URL = "https://api.polygon.io"
+def _intraday_ttl(key, value) -> float:
+    # Intraday bars keep forming while the market is open and are frozen until the next open otherwise
+    return 60 if is_open() else seconds_until(next_open())
 
 # Cache setup
-quote_cache = TTLCache(maxsize=100, ttl=300)   
-market_cache = TTLCache(maxsize=10, ttl=300)  
-options_cache = TTLCache(maxsize=100, ttl=300)
+market_cache = CoalescingCache(
+    "market", maxsize=10, ttl=300, stale_ttl=60, backend=shared_backend("market"), ttl_fn=_market_ttl
+)
+options_cache = CoalescingCache(
+    "options", maxsize=100, ttl=300, key_fn=normalize_symbol, backend=shared_backend("options")
+)
+intraday_cache = CoalescingCache(
+    "intraday", maxsize=500, ttl=60, key_fn=normalize_symbol, backend=shared_backend("intraday"), ttl_fn=_intraday_ttl
+)
+
+MAX_BATCH_SYMBOLS = 100
 
-def get_polygon_headers():
-    return {
-        "Authorization": f"Bearer {POLYGON_API_KEY}"
-    }
-    
-def get_sector_for_symbol(symbol: str) -> str:
-    try:
-        ticker = yf.Ticker(symbol)
-        info = ticker.info
-        return info.get('sector', 'Other')
-    except:
-        return 'Other'
-      
 @router.get("/portfolio/{user_id}/history")
-async def get_portfolio_history(user_id: str):
+async def get_portfolio_history(user_id: str, start: Optional[str] = None, end: Optional[str] = None):
+    # Daily closing values from the snapshot pipeline; start/end are YYYY-MM-DD
     try:
-        user = users.find_one({"_id": ObjectId(user_id)})
+        snapshots = await get_history(user_id, start, end)
+        if snapshots:
+            return {
+                "dates": [snapshot["date"] for snapshot in snapshots],
+                "values": [snapshot["value"] for snapshot in snapshots]
+            }
+
+        # No snapshots yet (new user, or outside the range): current cash only
+        user = await users.find_one({"_id": ObjectId(user_id)}, {"cash": 1})
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
-
-        # Get or create default history
-        history = user.get("performance_history", {
+        return {
             "dates": [datetime.now().strftime("%Y-%m-%d")],
             "values": [user.get("cash", 25000.0)]
-        })
-
-        return history
+        }
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error fetching portfolio history: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -76,18 +98,23 @@ async def get_portfolio_history(user_id: str):
 @router.get("/portfolio/{user_id}/summary", response_model=PortfolioSummary)
 async def get_portfolio_summary(user_id: str):
     try:
-        user = users.find_one({"_id": ObjectId(user_id)})
+        user = await users.find_one({"_id": ObjectId(user_id)})
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
+        # Gain/loss from the stored cost basis, marked to current quotes
+        portfolio = user.get("portfolio", {})
+        positions, quotes = await asyncio.gather(
+            get_positions(user_id),
+            get_quotes(symbol for symbol, quantity in portfolio.items() if quantity > 0)
+        )
+        pnl = gain_loss(positions, portfolio, quotes)
+
         # Ensure all required fields exist with default values
         portfolio_summary = {
             "total_value": user.get("total_value", user.get("cash", 25000.0)),
-            "total_gain_loss": user.get("total_value", 25000.0) - user.get("initial_investment", 25000.0),
-            "total_gain_loss_percentage": (
-                (user.get("total_value", 25000.0) - user.get("initial_investment", 25000.0)) / 
-                user.get("initial_investment", 25000.0) * 100
-            ),
+            "total_gain_loss": pnl["total_gain_loss"],
+            "total_gain_loss_percentage": pnl["total_gain_loss_percentage"],
             "sector_allocation": user.get("sector_allocation", [{
                 "sector": "Cash",
                 "value": user.get("cash", 25000.0),
@@ -103,6 +130,8 @@ async def get_portfolio_summary(user_id: str):
 
         return portfolio_summary
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error fetching portfolio summary: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -117,8 +146,9 @@ async def get_sector_allocation(user_id: str):
         total_value = portfolio_data["total_value"]
 
         # Add positions by sector
+        sector_map = await get_sectors(position["symbol"] for position in portfolio_data["positions"])
         for position in portfolio_data["positions"]:
-            sector = get_sector_for_symbol(position["symbol"])
+            sector = sector_map[position["symbol"]]
             position_value = position["current_value"]
             sectors[sector] = sectors.get(sector, 0) + position_value
 
@@ -144,54 +174,20 @@ async def get_sector_allocation(user_id: str):
 @router.post("/options/trade")
 async def execute_option_trade(trade_data: OptionTradeRequest):
     try:
-        # Verify user exists
-        user = users.find_one({"_id": ObjectId(trade_data.user_id)})
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
+        # Guarded update and ledger write in one transaction
+        updated_user = await execute_option(
+            trade_data.user_id,
+            trade_data.symbol,
+            trade_data.option_type,
+            trade_data.strike,
+            trade_data.expiration,
+            trade_data.trade_type,
+            trade_data.quantity,
+            trade_data.premium
+        )
+
+        schedule_insights(trade_data.user_id)
 
-        # Calculate total cost (each contract is for 100 shares)
-        total_cost = float(trade_data.premium) * 100 * trade_data.quantity
-
-        # Get user's options and create position key
-        user_options = user.get("options", {})
-        position_key = f"options.{trade_data.symbol}-{trade_data.option_type}-{trade_data.strike}-{trade_data.expiration}"
-
-        if trade_data.trade_type == "BUY":
-            # Check if user has enough cash
-            if float(user.get("cash", 0)) < total_cost:
-                raise HTTPException(status_code=400, detail="Insufficient funds")
-
-            # Update user's cash and option position
-            result = users.update_one(
-                {"_id": ObjectId(trade_data.user_id)},
-                {
-                    "$inc": {
-                        "cash": -total_cost,
-                        position_key: trade_data.quantity
-                    }
-                }
-            )
-
-        else:  # SELL
-            # Check if user has enough contracts
-            current_position = float(user_options.get(f"{trade_data.symbol}-{trade_data.option_type}-{trade_data.strike}-{trade_data.expiration}", 0))
-            if current_position < float(trade_data.quantity):
-                raise HTTPException(status_code=400, detail="Insufficient contracts to sell")
-
-            # Update user's cash and option position
-            result = users.update_one(
-                {"_id": ObjectId(trade_data.user_id)},
-                {
-                    "$inc": {
-                        "cash": total_cost,
-                        position_key: -trade_data.quantity
-                    }
-                }
-            )
-
-        # Get updated portfolio
-        updated_user = users.find_one({"_id": ObjectId(trade_data.user_id)})
-        
         # Format portfolio response
         portfolio_response = {
             "cash": float(updated_user.get("cash", 0)),
@@ -208,27 +204,29 @@ async def execute_option_trade(trade_data: OptionTradeRequest):
                     "quantity": float(qty)
                 })
 
-        # Add options positions
-        for opt_key, qty in updated_user.get("options", {}).items():
-            if float(qty) > 0:
-                symbol, opt_type, strike, exp = opt_key.split("-")
-                option_position = {
-                    "symbol": symbol,
-                    "option_type": opt_type,
-                    "strike": float(strike),
-                    "expiration": exp,
-                    "quantity": float(qty)
-                }
-                portfolio_response["options"].append(option_position)
+        # Add options positions; the expiration has dashes of its own, so
+        # only the first three split off
+        for opt_key, qty in option_holdings(updated_user).items():
+            symbol, opt_type, strike, exp = opt_key.split("-", 3)
+            option_position = {
+                "symbol": symbol,
+                "option_type": opt_type,
+                "strike": float(strike),
+                "expiration": exp,
+                "quantity": qty
+            }
+            portfolio_response["options"].append(option_position)
 
         return portfolio_response
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error executing option trade: {e}")
         raise HTTPException(status_code=500, detail=str(e))
       
 async def get_portfolio(user_id: str):
-    user = users.find_one({"_id": ObjectId(user_id)})
+    user = await users.find_one({"_id": ObjectId(user_id)})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
         
@@ -238,10 +236,13 @@ async def get_portfolio(user_id: str):
         "total_value": user.get("cash", 0)
     }
 
-    for symbol, quantity in user.get("portfolio", {}).items():
-        if quantity > 0:
+    holdings = {symbol: quantity for symbol, quantity in user.get("portfolio", {}).items() if quantity > 0}
+    quotes = await get_quotes(holdings)
+
+    for symbol, quantity in holdings.items():
+        if symbol in quotes:
             try:
-                quote = await get_stock_quote(symbol)
+                quote = quotes[symbol]
                 position_value = quantity * quote["price"]
                 portfolio_data["positions"].append({
                     "symbol": symbol,
@@ -265,75 +266,135 @@ async def get_portfolio_route(user_id: str):
 
 @router.get("/quote/{symbol}")
 async def get_stock_quote(symbol: str):
-    # Check cache first
-    if symbol in quote_cache:
-        return quote_cache[symbol]
+    return await get_quote(symbol)
+
+
+@router.get("/quotes")
+async def get_stock_quotes(symbols: str = Query(..., min_length=1)):
+    requested = [symbol.strip() for symbol in symbols.split(",") if symbol.strip()]
+    if not requested:
+        raise HTTPException(status_code=400, detail="At least one symbol is required")
+    if len(requested) > MAX_BATCH_SYMBOLS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_SYMBOLS} symbols per request")
 
     try:
-        # Polygon previous day's aggregates endpoint:
-        # GET /v2/aggs/ticker/{symbol}/prev?adjusted=true
-        url = f"{BASE_POLYGON_URL}/v2/aggs/ticker/{symbol.upper()}/prev"
-        params = {
-            "adjusted": "true"
+        quotes = await get_quotes(requested)
+        return {
+            "quotes": [quotes[symbol] for symbol in requested if symbol in quotes],
+            "missing": [symbol for symbol in requested if symbol not in quotes]
         }
-        response = requests.get(url, headers=get_polygon_headers(), params=params)
+    except Exception as e:
+        print(f"Error fetching batch quotes: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-        # Handle no data scenario (404 or empty results)
-        if response.status_code == 404:
-            raise HTTPException(status_code=404, detail="No data found for this symbol.")
 
-        response.raise_for_status()
-        data = response.json()
+@router.get("/cache/stats")
+async def get_cache_stats():
+    # Hit/miss counters per tier for every market-data cache in this worker
+    return cache_stats()
 
-        results = data.get("results", [])
-        if not results:
-            # No results returned
-            raise HTTPException(status_code=404, detail="No previous trading day data found.")
 
-        # The endpoint returns an array of one aggregate bar representing the previous trading day
-        bar = results[0]  # bar includes o, c, h, l, etc.
-        open_price = bar.get("o", 0)
-        close_price = bar.get("c", 0)
-        high_price = bar.get("h", 0)
-        low_price = bar.get("l", 0)
+@router.get("/refresher/stats")
+async def get_refresher_stats():
+    # Progress of the background hot-symbol quote refresher in this worker
+    return quote_refresher.stats
 
-        if open_price == 0:
-            # If open_price is zero, avoid division by zero in percentChange
-            raise HTTPException(status_code=500, detail="Invalid data: open price is zero.")
 
-        change = close_price - open_price
-        percentChange = (change / open_price) * 100
+async def _stream_symbols(symbols: Optional[str], user_id: Optional[str]) -> List[str]:
+    # Explicit symbols, or the user's watchlist when none are given
+    if symbols:
+        return [symbol.strip() for symbol in symbols.split(",") if symbol.strip()]
+    if user_id:
+        user = await users.find_one({"_id": ObjectId(user_id)}, {"watchlist": 1})
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        return user.get("watchlist", [])
+    raise HTTPException(status_code=400, detail="Provide symbols or user_id")
 
-        result = {
-            "symbol": symbol.upper(),
-            "price": float(close_price),
-            "change": float(change),
-            "percentChange": float(percentChange),
-            "high": float(high_price),
-            "low": float(low_price),
-            "open": float(open_price),
-            "previousClose": float(open_price),  # Using open as a stand-in for previousClose
-            "name": symbol.upper(),
-            "currency": "USD",
-            "marketCap": 0  # Not provided by this endpoint
-        }
 
-        quote_cache[symbol] = result
-        return result
+@router.get("/stream")
+async def stream_quotes(symbols: Optional[str] = None, user_id: Optional[str] = None):
+    # Server-sent events: the latest quote for each symbol on connect, then
+    # only the fields that change
+    requested = await _stream_symbols(symbols, user_id)
 
-    except requests.HTTPError as e:
-        print(f"Polygon API Error for quote: {str(e)}")
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to fetch quote data: {str(e)}"
-        )
-    except Exception as e:
-        print(f"Unexpected Error in quote: {str(e)}")
-        raise HTTPException(
-            status_code=500,
-            detail=f"An unexpected error occurred: {str(e)}"
-        )
+    async def events():
+        subscription = quote_hub.connect()
+        try:
+            await quote_hub.subscribe(subscription, requested)
+            while True:
+                batch = await subscription.next_batch(STREAM_HEARTBEAT)
+                if batch:
+                    yield f"event: quotes\ndata: {json.dumps(batch)}\n\n"
+                else:
+                    yield ": keep-alive\n\n"
+        finally:
+            quote_hub.disconnect(subscription)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.websocket("/stream/ws")
+async def stream_quotes_ws(websocket: WebSocket, symbols: Optional[str] = None, user_id: Optional[str] = None):
+    # Same feed over a WebSocket; clients can change their symbols with
+    # {"action": "subscribe" | "unsubscribe", "symbols": [...]}
+    await websocket.accept()
+    subscription = quote_hub.connect()
+
+    async def receive():
+        while True:
+            try:
+                message = json.loads(await websocket.receive_text())
+            except ValueError:
+                await websocket.send_json({"type": "error", "detail": "Messages must be JSON"})
+                continue
+            if not isinstance(message, dict):
+                message = {}
+            action = message.get("action")
+            requested = message.get("symbols") or []
+            if action not in ("subscribe", "unsubscribe"):
+                await websocket.send_json({"type": "error", "detail": 'action must be "subscribe" or "unsubscribe"'})
+                continue
+            if not isinstance(requested, list) or not all(isinstance(symbol, str) for symbol in requested):
+                await websocket.send_json({"type": "error", "detail": "symbols must be a list of strings"})
+                continue
+            if action == "subscribe":
+                added = await quote_hub.subscribe(subscription, requested)
+                await websocket.send_json({"type": "subscribed", "symbols": added})
+            else:
+                quote_hub.unsubscribe(subscription, requested)
+                await websocket.send_json({"type": "unsubscribed", "symbols": requested})
+
+    async def send():
+        while True:
+            batch = await subscription.next_batch(STREAM_HEARTBEAT)
+            await websocket.send_json({"type": "quotes", "data": batch} if batch else {"type": "ping"})
 
+    try:
+        if symbols or user_id:
+            await quote_hub.subscribe(subscription, await _stream_symbols(symbols, user_id))
+        tasks = [asyncio.create_task(receive()), asyncio.create_task(send())]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            task.result()
+    except WebSocketDisconnect:
+        pass
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=e.detail)
+    finally:
+        quote_hub.disconnect(subscription)
+
+
+@router.get("/stream/stats")
+async def get_stream_stats():
+    # Open streaming connections and fan-out counters in this worker
+    return quote_hub.snapshot_stats()
 
 
 @router.get("/historical/{symbol}")
@@ -368,16 +429,27 @@ async def get_historical_data(symbol: str, timeframe: str = "1D"):
         multiplier = 15
         timespan = "minute"
 
-    from_str = from_dt.strftime('%Y-%m-%d')
-    to_str = now.strftime('%Y-%m-%d')
+    try:
+        if timespan in ["day", "week"]:
+            # Completed daily bars never change, so they come from the local
+            # store (which only fetches the missing tail); weeks are rolled up locally
+            bars = await daily_bars.get_range(symbol, from_dt.date(), now.date())
+            if timespan == "week":
+                bars = resample_weekly(bars)
+            return {
+                "symbol": symbol.upper(),
+                "timeframe": timeframe,
+                "labels": [str(d) for d in bar_dates(bars)],
+                "prices": bars["c"].tolist()
+            }
 
-    url = f"{BASE_POLYGON_URL}/v2/aggs/ticker/{symbol.upper()}/range/{multiplier}/{timespan}/{from_str}/{to_str}"
-    params = {"adjusted": "true", "sort": "asc", "limit": 50000}
+        from_str = from_dt.strftime('%Y-%m-%d')
+        to_str = now.strftime('%Y-%m-%d')
 
-    try:
-        response = requests.get(url, headers=get_polygon_headers(), params=params)
-        response.raise_for_status()
-        data = response.json()
+        url = f"/v2/aggs/ticker/{symbol.upper()}/range/{multiplier}/{timespan}/{from_str}/{to_str}"
+        params = {"adjusted": "true", "sort": "asc", "limit": 50000}
+
+        data = await intraday_cache.get_or_fetch(symbol, lambda: polygon.get_json(url, params=params))
 
         if data.get("resultsCount", 0) == 0:
             return {
@@ -408,7 +480,7 @@ async def get_historical_data(symbol: str, timeframe: str = "1D"):
             "prices": prices
         }
 
-    except requests.HTTPError as e:
+    except httpx.HTTPStatusError as e:
         print(f"Polygon API Error for historical: {str(e)}")
         raise HTTPException(
             status_code=500,
@@ -424,57 +496,60 @@ async def get_historical_data(symbol: str, timeframe: str = "1D"):
 @router.get("/options/{symbol}")
 async def get_options_chain(symbol: str):
     try:
-        # Get the base stock price from your existing quote endpoint
-        stock_price = 100  # Default price if none found
-        strike_range = [-10, -5, -2, 2, 5, 10]  # Strike price differences
-        
-        # Generate expiration dates (next 4 fridays)
-        expirations = []
-        current_date = datetime.now()
-        for _ in range(4):
-            days_until_friday = (4 - current_date.weekday()) % 7
-            if days_until_friday == 0:
-                days_until_friday = 7
-            current_date += timedelta(days=days_until_friday)
-            expirations.append(current_date.strftime("%Y-%m-%d"))
-
-        calls = []
-        puts = []
-
-        for exp in expirations:
-            for strike_diff in strike_range:
-                strike = round(stock_price + strike_diff, 2)
-                
-                # Calculate call premium
-                call_intrinsic = max(0, stock_price - strike)
-                call_premium = round(call_intrinsic + random.uniform(0.5, 2.0), 2)
-                
-                calls.append({
-                    "strike": strike,
-                    "premium": call_premium,
-                    "expiration": exp,
-                    "type": "CALL"
-                })
-
-                # Calculate put premium
-                put_intrinsic = max(0, strike - stock_price)
-                put_premium = round(put_intrinsic + random.uniform(0.5, 2.0), 2)
-                
-                puts.append({
-                    "strike": strike,
-                    "premium": put_premium,
-                    "expiration": exp,
-                    "type": "PUT"
-                })
-
-        return {
-            "calls": calls,
-            "puts": puts,
-            "underlying_price": stock_price
-        }
+        return await options_cache.get_or_fetch(symbol, _build_options_chain)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+async def _build_options_chain():
+    # Get the base stock price from your existing quote endpoint
+    stock_price = 100  # Default price if none found
+    strike_range = [-10, -5, -2, 2, 5, 10]  # Strike price differences
+    
+    # Generate expiration dates (next 4 fridays)
+    expirations = []
+    current_date = datetime.now()
+    for _ in range(4):
+        days_until_friday = (4 - current_date.weekday()) % 7
+        if days_until_friday == 0:
+            days_until_friday = 7
+        current_date += timedelta(days=days_until_friday)
+        expirations.append(current_date.strftime("%Y-%m-%d"))
+
+    calls = []
+    puts = []
+
+    for exp in expirations:
+        for strike_diff in strike_range:
+            strike = round(stock_price + strike_diff, 2)
+            
+            # Calculate call premium
+            call_intrinsic = max(0, stock_price - strike)
+            call_premium = round(call_intrinsic + random.uniform(0.5, 2.0), 2)
+            
+            calls.append({
+                "strike": strike,
+                "premium": call_premium,
+                "expiration": exp,
+                "type": "CALL"
+            })
+
+            # Calculate put premium
+            put_intrinsic = max(0, strike - stock_price)
+            put_premium = round(put_intrinsic + random.uniform(0.5, 2.0), 2)
+            
+            puts.append({
+                "strike": strike,
+                "premium": put_premium,
+                "expiration": exp,
+                "type": "PUT"
+            })
+
+    return {
+        "calls": calls,
+        "puts": puts,
+        "underlying_price": stock_price
+    }
       
       
 @router.post("/trade")
@@ -483,41 +558,11 @@ async def execute_stock_trade(
     user_id: str = Query(...)  # Query parameter with default comes after
 ):
     try:
-        user = users.find_one({"_id": ObjectId(user_id)})
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-            
-        total_cost = trade.price * trade.quantity
-        
-        if trade.type == "BUY":
-            if user["cash"] < total_cost:
-                raise HTTPException(status_code=400, detail="Insufficient funds")
-                
-            result = users.update_one(
-                {"_id": ObjectId(user_id)},
-                {
-                    "$inc": {
-                        "cash": -total_cost,
-                        f"portfolio.{trade.symbol}": trade.quantity
-                    }
-                }
-            )
-        else:  # SELL
-            current_position = user.get("portfolio", {}).get(trade.symbol, 0)
-            if current_position < trade.quantity:
-                raise HTTPException(status_code=400, detail="Insufficient shares")
-                
-            result = users.update_one(
-                {"_id": ObjectId(user_id)},
-                {
-                    "$inc": {
-                        "cash": total_cost,
-                        f"portfolio.{trade.symbol}": -trade.quantity
-                    }
-                }
-            )
-            
-        updated_user = users.find_one({"_id": ObjectId(user_id)})
+        # Guarded update and ledger write in one transaction
+        updated_user = await execute_stock(user_id, trade.symbol, trade.type, trade.quantity, trade.price)
+
+        schedule_insights(user_id)
+
         return {
             "cash": updated_user["cash"],
             "positions": [
@@ -528,6 +573,8 @@ async def execute_stock_trade(
             "total_value": updated_user["cash"]
         }
             
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Trade execution error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -535,64 +582,59 @@ async def execute_stock_trade(
 @router.get("/market/overview")
 async def get_market_overview():
     try:
-        cache_key = "market_overview"
-        if cache_key in market_cache:
-            return market_cache[cache_key]
-
-        status_response = requests.get(f"{BASE_POLYGON_URL}/v1/marketstatus/now", headers=get_polygon_headers())
-        status_response.raise_for_status()
-        status_data = status_response.json()
-
-        market_is_open = status_data.get("market", "closed") == "open"
-
-        end = datetime.utcnow()
-        start = end - timedelta(days=2)
-        s_url = f"{BASE_POLYGON_URL}/v2/aggs/ticker/INX/range/1/day/{start.strftime('%Y-%m-%d')}/{end.strftime('%Y-%m-%d')}"
-        s_resp = requests.get(s_url, headers=get_polygon_headers())
-        s_resp.raise_for_status()
-        s_data = s_resp.json()
-        sp_value = 0.0
-        sp_change_percent = 0.0
-        if s_data.get("resultsCount", 0) > 0:
-            results = s_data["results"]
-            sp_value = results[-1]["c"]
-            if len(results) > 1:
-                prev_close = results[-2]["c"]
-                sp_change_percent = ((sp_value - prev_close) / prev_close) * 100 if prev_close else 0.0
-
-        news_url = f"{BASE_POLYGON_URL}/v2/reference/news"
-        news_params = {"limit": 5}
-        news_resp = requests.get(news_url, headers=get_polygon_headers(), params=news_params)
-        news_resp.raise_for_status()
-        news_data = news_resp.json()
-        news_items = news_data.get("results", [])[:5]
-
-        overview = {
-            "market_status": "Open" if market_is_open else "Closed",
-            "sp500": {
-                "value": float(sp_value),
-                "changePercent": float(sp_change_percent)
-            },
-            "tradingVolume": None,
-            "market_news": news_items
-        }
-
-        market_cache[cache_key] = overview
-        return overview
+        return await market_cache.get_or_fetch("market_overview", _fetch_market_overview)
 
-    except requests.HTTPError as e:
+    except httpx.HTTPStatusError as e:
         print(f"Polygon API Error for market overview: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch market overview: {str(e)}")
     except Exception as e:
         print(f"Unexpected Error in market overview: {str(e)}")
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
 
+async def _fetch_market_overview():
+    end = datetime.utcnow()
+    start = end - timedelta(days=2)
+    s_url = f"/v2/aggs/ticker/INX/range/1/day/{start.strftime('%Y-%m-%d')}/{end.strftime('%Y-%m-%d')}"
+
+    # The three upstream calls are independent, so issue them concurrently;
+    # the status is cached on its own until the next open/close
+    status_data, s_data, news_data = await asyncio.gather(
+        market_cache.get_or_fetch("market_status", lambda: polygon.get_json("/v1/marketstatus/now")),
+        polygon.get_json(s_url),
+        polygon.get_json("/v2/reference/news", params={"limit": 5}),
+    )
+
+    market_is_open = status_data.get("market", "closed") == "open"
+
+    sp_value = 0.0
+    sp_change_percent = 0.0
+    if s_data.get("resultsCount", 0) > 0:
+        results = s_data["results"]
+        sp_value = results[-1]["c"]
+        if len(results) > 1:
+            prev_close = results[-2]["c"]
+            sp_change_percent = ((sp_value - prev_close) / prev_close) * 100 if prev_close else 0.0
+
+    news_items = news_data.get("results", [])[:5]
+
+    overview = {
+        "market_status": "Open" if market_is_open else "Closed",
+        "sp500": {
+            "value": float(sp_value),
+            "changePercent": float(sp_change_percent)
+        },
+        "tradingVolume": None,
+        "market_news": news_items
+    }
+
+    return overview
+
 
 @router.get("/search")
 async def search_stocks(query: str = Query(..., min_length=1)):
     try:
         # Using Polygon.io's Ticker Search endpoint
-        search_url = f"{BASE_POLYGON_URL}/v3/reference/tickers"
+        search_url = "/v3/reference/tickers"
         search_params = {
             "search": query,
             "active": "true",
@@ -601,10 +643,7 @@ async def search_stocks(query: str = Query(..., min_length=1)):
             "sort": "ticker"     # Sort by ticker symbol
         }
         
-        headers = get_polygon_headers()
-        resp = requests.get(search_url, headers=headers, params=search_params)
-        resp.raise_for_status()
-        data = resp.json()
+        data = await polygon.get_json(search_url, params=search_params)
 
         # Process and format the results
         results = []
@@ -622,7 +661,7 @@ async def search_stocks(query: str = Query(..., min_length=1)):
             "count": len(results)
         }
 
-    except requests.HTTPError as e:
+    except httpx.HTTPStatusError as e:
         print(f"Polygon API Error for search: {str(e)}")
         raise HTTPException(
             status_code=500,
@@ -637,67 +676,45 @@ async def search_stocks(query: str = Query(..., min_length=1)):
 
 @router.get("/performance/{user_id}")
 async def get_performance_metrics(user_id: str, timeframe: str = "1M"):
+    # Daily portfolio return vs SPY, rebuilt from the trade ledger and local closes
     try:
-        # Verify user exists
-        user = users.find_one({"_id": ObjectId(user_id)})
+        user = await users.find_one({"_id": ObjectId(user_id)}, {"portfolio": 1, "options": 1, "cash": 1})
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        end_date = datetime.now()
-        if timeframe == "1M":
-            start_date = end_date - timedelta(days=30)
-        elif timeframe == "3M":
-            start_date = end_date - timedelta(days=90)
-        elif timeframe == "YTD":
-            start_date = datetime(end_date.year, 1, 1)
-        else:  # ALL
-            start_date = end_date - timedelta(days=365) 
-
-        # Get portfolio positions
-        portfolio = user.get("portfolio", {})
-        
-        # Get S&P 500 data for comparison
-        sp500_url = f"{BASE_POLYGON_URL}/v2/aggs/ticker/SPY/range/1/day/{start_date.strftime('%Y-%m-%d')}/{end_date.strftime('%Y-%m-%d')}"
-        sp500_response = requests.get(sp500_url, headers=get_polygon_headers())
-        sp500_response.raise_for_status()
-        sp500_data = sp500_response.json()
-
-        # Process the data
-        dates = []
-        portfolio_values = []
-        benchmark_values = []
-
-        if sp500_data.get("results"):
-            initial_sp500 = sp500_data["results"][0]["c"]
-            for result in sp500_data["results"]:
-                date = datetime.fromtimestamp(result["t"] / 1000).strftime('%Y-%m-%d')
-                dates.append(date)
-                
-                benchmark_value = (result["c"] / initial_sp500 - 1) * 100
-                benchmark_values.append(round(benchmark_value, 2))
-
-                portfolio_value = benchmark_value + random.uniform(-1, 1)  
-                portfolio_values.append(round(portfolio_value, 2))
-
-        return {
-            "labels": dates,
-            "portfolio": portfolio_values,
-            "benchmark": benchmark_values
-        }
+        return await performance_series(user, timeframe)
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error fetching performance metrics: {e}")
         raise HTTPException(status_code=500, detail=str(e))
       
 
 @router.get("/transactions/{user_id}")
-async def get_transactions(user_id: str):
+async def get_transactions(
+    user_id: str,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(10, ge=1, le=100),
+    symbol: Optional[str] = None,
+    kind: Optional[str] = Query(None, pattern="^(stock|option)$"),
+    start: Optional[str] = None,
+    end: Optional[str] = None
+):
+    # Newest first; the next page's cursor comes back in X-Next-Cursor
     try:
-        user_trades = list(trades.find(
-            {"user_id": ObjectId(user_id)},
-            sort=[("timestamp", -1)],
-            limit=10
-        ))
+        user_trades, next_cursor = await list_trades(
+            user_id,
+            symbol=normalize_symbol(symbol) if symbol else None,
+            kind=kind,
+            start=datetime.fromisoformat(start) if start else None,
+            end=datetime.fromisoformat(end) + timedelta(days=1) if end else None,
+            cursor=cursor,
+            limit=limit
+        )
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
         
         formatted_trades = []
         for trade in user_trades:
@@ -727,6 +744,10 @@ async def get_transactions(user_id: str):
             
         return formatted_trades
         
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         print(f"Error fetching transactions: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -735,7 +756,7 @@ async def get_transactions(user_id: str):
 @router.get("/portfolio/{user_id}/sector-allocation")
 async def get_sector_allocation(user_id: str):
     try:
-        user = users.find_one({"_id": ObjectId(user_id)})
+        user = await users.find_one({"_id": ObjectId(user_id)})
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
@@ -744,15 +765,17 @@ async def get_sector_allocation(user_id: str):
         sectors["Cash"] = total_value
 
         portfolio = user.get("portfolio", {})
+        held = [symbol for symbol, quantity in portfolio.items() if quantity > 0]
+        quotes, sector_map = await asyncio.gather(get_quotes(held), get_sectors(held))
 
         for symbol, quantity in portfolio.items():
             try:
-                if quantity > 0:
-                    quote = await get_stock_quote(symbol)
+                if quantity > 0 and symbol in quotes:
+                    quote = quotes[symbol]
                     position_value = float(quantity) * float(quote["price"])
                     total_value += position_value
 
-                    sector = get_sector_for_symbol(symbol)
+                    sector = sector_map[symbol]
                     sectors[sector] = sectors.get(sector, 0) + position_value
 
             except Exception as e:
@@ -787,53 +810,34 @@ async def get_sector_allocation(user_id: str):
 async def get_portfolio_performance(user_id: str):
     try:
         # Verify user exists
-        user = users.find_one({"_id": ObjectId(user_id)})
+        user = await users.find_one({"_id": ObjectId(user_id)})
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
             
-        # Initialize variables with safe defaults
-        total_invested = 0
-        realized_gains = 0
-        unrealized_gains = 0
-        current_value = float(user.get("cash", 0))  # Convert to float for safety
-        
-        # Get portfolio positions
+        # Precomputed lot state plus current quotes; no ledger replay
         portfolio = user.get("portfolio", {})
-        
-        # Calculate current portfolio value and unrealized gains
-        for symbol, quantity in portfolio.items():
-            try:
-                if quantity > 0:  # Only process active positions
-                    quote = await get_stock_quote(symbol)
-                    position_value = float(quantity) * float(quote["price"])
-                    current_value += position_value
-                    
-                    # For now, assume cost basis is initial investment
-                    # You may want to implement a more sophisticated cost basis calculation
-                    unrealized_gains += position_value - (float(quantity) * float(quote["price"]))
-            except Exception as e:
-                print(f"Error processing position for {symbol}: {e}")
-                continue
-        
-        # Calculate total gains
-        total_gain_loss = realized_gains + unrealized_gains
-        
-        # Safe calculation of percentage with check for zero
-        total_gain_loss_percentage = (
-            (total_gain_loss / total_invested * 100)
-            if total_invested and total_invested > 0
-            else 0
+        positions, quotes = await asyncio.gather(
+            get_positions(user_id),
+            get_quotes(symbol for symbol, quantity in portfolio.items() if quantity > 0)
         )
-        
+
+        current_value = float(user.get("cash", 0))
+        for symbol, quantity in portfolio.items():
+            if quantity > 0 and symbol in quotes:
+                current_value += float(quantity) * float(quotes[symbol]["price"])
+
+        pnl = gain_loss(positions, portfolio, quotes)
         return {
             "total_value": float(current_value),
-            "total_gain_loss": float(total_gain_loss),
-            "total_gain_loss_percentage": float(total_gain_loss_percentage),
-            "realized_gains": float(realized_gains),
-            "unrealized_gains": float(unrealized_gains),
-            "total_invested": float(total_invested)
+            "total_gain_loss": float(pnl["total_gain_loss"]),
+            "total_gain_loss_percentage": float(pnl["total_gain_loss_percentage"]),
+            "realized_gains": float(pnl["realized_gains"]),
+            "unrealized_gains": float(pnl["unrealized_gains"]),
+            "total_invested": float(pnl["total_invested"])
         }
-        
+
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error calculating portfolio performance: {str(e)}")
         # Return a more detailed error message
@@ -845,72 +849,44 @@ async def get_portfolio_performance(user_id: str):
 
 @router.get("/insights/{user_id}")
 async def get_portfolio_insights(user_id: str):
+    # Insights are regenerated in the background when holdings change, so
+    # this normally just reads the stored result (and the user, to check
+    # it is still current)
     try:
-        user = users.find_one({"_id": ObjectId(user_id)})
-        if not user:
+        insights = await get_insights(user_id)
+        if insights is None:
             raise HTTPException(status_code=404, detail="User not found")
+        return insights
 
-        # Get portfolio data
-        portfolio = user.get("portfolio", {})
-        positions = user.get("positions", [])
-        total_value = float(user.get("total_value", 0) or 0)
-        cash = float(user.get("cash", 0) or 0)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error getting portfolio insights: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to generate portfolio insights")
 
-        # Format data for ChatGPT
-        prompt = f"""
-        Analyze this investment portfolio and provide insights:
 
-        Total Portfolio Value: ${total_value:,.2f}
-        Cash Position: ${cash:,.2f}
-        
-        Current Positions:
-        {positions}
-
-        Provide a JSON response with the following structure:
-        {{
-            "risk_level": "Low" or "Moderate" or "High",
-            "health_score": number between 0-100,
-            "health_rating": descriptive rating of the health score,
-            "recommendations": [
-                {{
-                    "title": "brief title",
-                    "description": "detailed recommendation"
-                }},
-                ... (up to 3 recommendations)
-            ]
-        }}
-
-        Base the analysis on:
-        - Diversification
-        - Sector allocation
-        - Cash position
-        - Risk exposure
-        - Current market conditions
-        """
-
-        # Get ChatGPT response
-        chatbot = ChatGPT()  # Your ChatGPT service instance
-        response = await chatbot._get_response(prompt, [])
-        
-        # Parse and validate response
-        try:
-            import json
-            insights = json.loads(response)
-            return insights
-        except json.JSONDecodeError:
-            # Fallback response if ChatGPT output isn't valid JSON
-            return {
-                "risk_level": "Moderate",
-                "health_score": 70,
-                "health_rating": "Good",
-                "recommendations": [
-                    {
-                        "title": "Regular Review",
-                        "description": "Schedule periodic portfolio reviews"
-                    }
-                ]
-            }
+async def _run_insights(params: Dict) -> Dict:
+    insights = await generate_insights(params["user_id"])
+    if insights is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return insights
+
+register_handler("insights", _run_insights)
 
+
+@router.post("/insights/{user_id}/jobs", status_code=202)
+async def submit_portfolio_insights(user_id: str):
+    # Queues (re)generation and returns at once; the job is keyed by the
+    # portfolio composition, so repeat submissions share it until holdings change
+    try:
+        user = await users.find_one({"_id": ObjectId(user_id)})
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        job, _ = await submit_job("insights", {"user_id": user_id, "composition": composition_hash(user)})
+        return job_accepted(job)
+
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error getting portfolio insights: {str(e)}")
-        raise HTTPException(status_code=500, detail="Failed to generate portfolio insights")
+        print(f"Error submitting portfolio insights job: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
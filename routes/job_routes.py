@@ -0,0 +1,42 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import JSONResponse
+from typing import Dict
+from ..services.jobs import DONE, FAILED, get_job, public_job
+
+router = APIRouter()
+
+# Suggested client poll interval while a job is pending, in seconds
+POLL_AFTER = "2"
+
+
+def job_accepted(job: Dict) -> JSONResponse:
+    # 202 pointing the client at the job's status and result URLs
+    return JSONResponse(
+        status_code=202,
+        content={
+            **public_job(job),
+            "status_url": f"/api/jobs/{job['_id']}",
+            "result_url": f"/api/jobs/{job['_id']}/result",
+        },
+        headers={"Location": f"/api/jobs/{job['_id']}", "Retry-After": POLL_AFTER}
+    )
+
+
+@router.get("/{job_id}")
+async def get_job_status(job_id: str):
+    job = await get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return public_job(job)
+
+
+@router.get("/{job_id}/result")
+async def get_job_result(job_id: str):
+    job = await get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    if job["status"] == DONE:
+        return job["result"]
+    if job["status"] == FAILED:
+        raise HTTPException(status_code=500, detail=job.get("error") or "Job failed")
+    return JSONResponse(status_code=202, content=public_job(job), headers={"Retry-After": POLL_AFTER})
@@ -1,4 +1,4 @@
-from pydantic import BaseModel, HttpUrl
+from pydantic import BaseModel, Field, HttpUrl
 from datetime import datetime
 from typing import List, Dict, Literal, Optional
 
@@ -37,10 +37,10 @@ class OptionTradeRequest(BaseModel):
     symbol: str
     option_type: Literal["CALL", "PUT"]
     strike: float
-    premium: float
+    premium: float = Field(gt=0)
     expiration: str
     trade_type: Literal["BUY", "SELL"]
-    quantity: int
+    quantity: int = Field(gt=0)
 
 class Position(BaseModel):
     symbol: str
@@ -102,9 +102,9 @@ class PortfolioAnalysisRequest(BaseModel):
 
 class StockTrade(BaseModel):
     symbol: str
-    type: str  
-    quantity: int
-    price: float
+    type: Literal["BUY", "SELL"]
+    quantity: int = Field(gt=0)
+    price: float = Field(gt=0)
 
 class ProfilePictureUpdate(BaseModel):
     profile_picture: HttpUrl
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import logging
+import os
+import re
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from .cache import normalize_symbol
+from .market_calendar import DAILY_BAR_DELAY, last_completed_session
+from .market_data import polygon
+
+logger = logging.getLogger(__name__)
+
+# One record per bar; t is the bar start in epoch milliseconds (Polygon's convention)
+BAR_DTYPE = np.dtype([
+    ("t", "<i8"),
+    ("o", "<f8"),
+    ("h", "<f8"),
+    ("l", "<f8"),
+    ("c", "<f8"),
+    ("v", "<f8"),
+])
+
+BAR_STORE_DIR = Path(os.getenv("BAR_STORE_DIR", Path(__file__).resolve().parent.parent / "data" / "bars"))
+
+# The first fetch for a symbol backfills this far so every chart view shares it
+BAR_HISTORY_DAYS = int(os.getenv("BAR_HISTORY_DAYS", "400"))
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+# Symbols become file names, so only plain ticker characters are accepted
+_SYMBOL_RE = re.compile(r"^[A-Z0-9.\-]{1,16}$")
+
+
+def _date_ms(d: date) -> int:
+    return int(datetime(d.year, d.month, d.day, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def bar_dates(bars: np.ndarray) -> np.ndarray:
+    # Calendar date of each bar as datetime64[D]
+    return bars["t"].astype("datetime64[ms]").astype("datetime64[D]")
+
+
+def resample_weekly(bars: np.ndarray) -> np.ndarray:
+    # Rolls daily bars up into Monday-based weeks, stamped with each week's first bar
+    if len(bars) == 0:
+        return bars
+    # 1970-01-01 was a Thursday, so shifting by 3 days aligns week boundaries to Mondays
+    week = (bars["t"] // DAY_MS + 3) // 7
+    starts = np.flatnonzero(np.r_[True, week[1:] != week[:-1]])
+    ends = np.r_[starts[1:], len(bars)] - 1
+
+    weekly = np.empty(len(starts), dtype=BAR_DTYPE)
+    weekly["t"] = bars["t"][starts]
+    weekly["o"] = bars["o"][starts]
+    weekly["h"] = np.maximum.reduceat(bars["h"], starts)
+    weekly["l"] = np.minimum.reduceat(bars["l"], starts)
+    weekly["c"] = bars["c"][ends]
+    weekly["v"] = np.add.reduceat(bars["v"], starts)
+    return weekly
+
+
+class BarStore:
+    # Local OHLCV store for one resolution, one memory-mapped .npy file per
+    # symbol plus a small JSON sidecar recording the date range already synced.
+    # Requests only go upstream for the part of the range not yet on disk.
+    def __init__(self, root: Path = BAR_STORE_DIR, multiplier: int = 1, timespan: str = "day"):
+        self.multiplier = multiplier
+        self.timespan = timespan
+        self.root = Path(root) / f"{multiplier}{timespan}"
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def _paths(self, symbol: str) -> Tuple[Path, Path]:
+        return self.root / f"{symbol}.npy", self.root / f"{symbol}.json"
+
+    def load(self, symbol: str) -> Tuple[np.ndarray, Optional[Dict]]:
+        bars_path, meta_path = self._paths(symbol)
+        try:
+            meta = json.loads(meta_path.read_text())
+            bars = np.load(bars_path, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return np.empty(0, dtype=BAR_DTYPE), None
+        return bars, meta
+
+    def _save(self, symbol: str, bars: np.ndarray, meta: Dict):
+        # Write-then-rename so readers (and other workers) never see a partial file
+        self.root.mkdir(parents=True, exist_ok=True)
+        bars_path, meta_path = self._paths(symbol)
+        tmp_bars = bars_path.with_suffix(f".{os.getpid()}.tmp.npy")
+        tmp_meta = meta_path.with_suffix(f".{os.getpid()}.tmp")
+        np.save(tmp_bars, bars)
+        tmp_meta.write_text(json.dumps(meta))
+        os.replace(tmp_bars, bars_path)
+        os.replace(tmp_meta, meta_path)
+
+    async def _fetch(self, symbol: str, start: date, end: date) -> np.ndarray:
+        url = f"/v2/aggs/ticker/{symbol}/range/{self.multiplier}/{self.timespan}/{start:%Y-%m-%d}/{end:%Y-%m-%d}"
+        data = await polygon.get_json(url, params={"adjusted": "true", "sort": "asc", "limit": 50000})
+        results = data.get("results") or []
+        bars = np.empty(len(results), dtype=BAR_DTYPE)
+        for i, r in enumerate(results):
+            bars[i] = (r["t"], r.get("o", 0), r.get("h", 0), r.get("l", 0), r["c"], r.get("v", 0))
+        return bars
+
+    def last_complete_day(self) -> date:
+        # Only finished sessions are stored; nothing new appears until the next
+        # session has closed and its bar is published
+        return last_completed_session(grace=DAILY_BAR_DELAY)
+
+    async def sync(self, symbol: str, start: date) -> np.ndarray:
+        # Makes sure [start, last complete day] is on disk and returns all stored bars
+        symbol = normalize_symbol(symbol)
+        if not _SYMBOL_RE.match(symbol):
+            raise ValueError(f"Invalid symbol: {symbol!r}")
+        lock = self._locks.setdefault(symbol, asyncio.Lock())
+        async with lock:
+            bars, meta = self.load(symbol)
+            last_day = self.last_complete_day()
+            start = min(start, last_day)
+
+            if meta is None:
+                ranges = [(min(start, last_day - timedelta(days=BAR_HISTORY_DAYS)), last_day)]
+            else:
+                synced_from = date.fromisoformat(meta["from"])
+                synced_to = date.fromisoformat(meta["to"])
+                ranges = []
+                if start < synced_from:
+                    ranges.append((start, synced_from - timedelta(days=1)))
+                if synced_to < last_day:
+                    ranges.append((synced_to + timedelta(days=1), last_day))
+
+            if not ranges:
+                return bars
+
+            fetched = await asyncio.gather(*(self._fetch(symbol, a, b) for a, b in ranges))
+            # Fresh bars first so they win over stored ones on any overlap;
+            # np.unique also leaves the result sorted by t
+            merged = np.concatenate([*fetched, np.asarray(bars)])
+            _, keep = np.unique(merged["t"], return_index=True)
+            merged = merged[keep]
+
+            # The tail only counts as synced up to the last bar actually
+            # received, so a session bar that isn't published yet is asked
+            # for again on the next sync instead of being skipped for good
+            synced_to = None if meta is None else synced_to
+            if len(merged):
+                last_bar = bar_dates(merged)[-1].astype(date)
+                synced_to = max(synced_to, last_bar) if synced_to else last_bar
+            covered = ranges if meta is None else ranges + [(synced_from, synced_to)]
+            first = min(a for a, _ in covered)
+            new_meta = {
+                "from": first.isoformat(),
+                "to": min(synced_to, last_day).isoformat() if synced_to else (first - timedelta(days=1)).isoformat(),
+            }
+            await asyncio.to_thread(self._save, symbol, merged, new_meta)
+            logger.info(f"Bar store synced {symbol} {self.root.name}: {[(a.isoformat(), b.isoformat()) for a, b in ranges]}")
+            return merged
+
+    async def get_range(self, symbol: str, start: date, end: date) -> np.ndarray:
+        # Bars with start <= bar date <= end, served from disk after syncing any gap
+        bars = await self.sync(symbol, start)
+        lo = np.searchsorted(bars["t"], _date_ms(start), side="left")
+        hi = np.searchsorted(bars["t"], _date_ms(end + timedelta(days=1)), side="left")
+        return bars[lo:hi]
+
+
+daily_bars = BarStore()
@@ -0,0 +1,409 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+from cachetools import TLRUCache
+from pymongo import IndexModel, UpdateOne
+
+from ..database import db, register_indexes
+
+logger = logging.getLogger(__name__)
+
+Fetch = Callable[[], Awaitable[Any]]
+FetchMany = Callable[[List[Hashable]], Awaitable[Dict[Hashable, Any]]]
+TtlFn = Callable[[Hashable, Any], float]
+Entry = Tuple[Any, float, float]  # (value, fetched_at as epoch seconds, ttl)
+
+# Shared second tier: "mongo" (default) or "none" for process-local caching only
+CACHE_L2 = os.getenv("CACHE_L2", "mongo").lower()
+
+cache_entries = db.cache_entries
+if CACHE_L2 == "mongo":
+    # Mongo drops entries once they expire
+    register_indexes("cache_entries", IndexModel("expires_at", expireAfterSeconds=0))
+
+# Every cache registers itself here so stats can be reported in one place
+_caches: Dict[str, "CoalescingCache"] = {}
+
+
+class MongoCacheBackend:
+    # Cache entries shared across workers and restarts. Documents expire via a
+    # TTL index on expires_at (registered above).
+    def __init__(self, namespace: str, collection=cache_entries):
+        self.namespace = namespace
+        self.collection = collection
+
+    def _id(self, key: Hashable) -> str:
+        return f"{self.namespace}:{key}"
+
+    async def get_many(self, keys: List[Hashable]) -> Dict[Hashable, Entry]:
+        ids = {self._id(key): key for key in keys}
+        found: Dict[Hashable, Entry] = {}
+        async for doc in self.collection.find({"_id": {"$in": list(ids)}}):
+            found[ids[doc["_id"]]] = (doc["value"], doc["fetched_at"], doc.get("ttl", 0))
+        return found
+
+    async def set_many(self, entries: Dict[Hashable, Entry], stale_ttl: float):
+        if not entries:
+            return
+        await self.collection.bulk_write([
+            UpdateOne(
+                {"_id": self._id(key)},
+                {"$set": {
+                    "value": value,
+                    "fetched_at": fetched_at,
+                    "ttl": ttl,
+                    "expires_at": datetime.fromtimestamp(fetched_at + ttl + stale_ttl, timezone.utc),
+                }},
+                upsert=True,
+            )
+            for key, (value, fetched_at, ttl) in entries.items()
+        ], ordered=False)
+
+
+def shared_backend(namespace: str) -> Optional[MongoCacheBackend]:
+    return MongoCacheBackend(namespace) if CACHE_L2 == "mongo" else None
+
+
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    return {name: dict(cache.stats) for name, cache in _caches.items()}
+
+
+def normalize_symbol(symbol: Hashable) -> Hashable:
+    return symbol.strip().upper() if isinstance(symbol, str) else symbol
+
+
+def _log_refresh_error(key: Hashable, future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning(f"Background refresh failed for {key!r}: {future.exception()}")
+
+
+class CoalescingCache:
+    # Two-tier TTL cache: an in-process L1 in front of an optional shared L2.
+    # Concurrent misses for a key share one in-flight lookup (L2, then the
+    # upstream fetch). Entries older than `ttl` but within `stale_ttl` more
+    # seconds are served as-is while a single background refresh replaces them.
+    # `ttl_fn(key, value)`, when given, sets each entry's TTL from its content
+    # (e.g. market-calendar aware expiry); `ttl` is then only the fallback.
+    def __init__(
+        self,
+        name: str,
+        maxsize: int,
+        ttl: float,
+        stale_ttl: float = 0,
+        key_fn: Optional[Callable[[Hashable], Hashable]] = None,
+        backend: Optional[MongoCacheBackend] = None,
+        ttl_fn: Optional[TtlFn] = None,
+    ):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.key_fn = key_fn or (lambda key: key)
+        self.backend = backend
+        self.ttl_fn = ttl_fn
+        self._entries = TLRUCache(
+            maxsize=maxsize,
+            ttu=lambda key, entry, now: entry[1] + entry[2] + self.stale_ttl,
+            timer=time.time,
+        )
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.stats = {"l1_hits": 0, "l2_hits": 0, "misses": 0, "stale_served": 0, "l2_errors": 0}
+        _caches[name] = self
+
+    def _lookup(self, key: Hashable):
+        # Returns (value, is_fresh) or None when there is nothing usable
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, fetched_at, ttl = entry
+        age = time.time() - fetched_at
+        if age >= ttl + self.stale_ttl:
+            return None
+        return value, age < ttl
+
+    def _entry(self, key: Hashable, value: Any, fetched_at: float) -> Entry:
+        ttl = self.ttl
+        if self.ttl_fn is not None:
+            try:
+                ttl = self.ttl_fn(key, value)
+            except Exception as e:
+                logger.warning(f"{self.name}: ttl_fn failed for {key!r}, using default: {e}")
+        return value, fetched_at, ttl
+
+    def __contains__(self, key: Hashable) -> bool:
+        found = self._lookup(self.key_fn(key))
+        return found is not None and found[1]
+
+    def __getitem__(self, key: Hashable) -> Any:
+        found = self._lookup(self.key_fn(key))
+        if found is None or not found[1]:
+            raise KeyError(key)
+        return found[0]
+
+    def __setitem__(self, key: Hashable, value: Any):
+        key = self.key_fn(key)
+        self._entries[key] = self._entry(key, value, time.time())
+
+    def expires_in(self, key: Hashable) -> Optional[float]:
+        # Seconds until the entry goes stale (negative once it is), None if absent
+        entry = self._entries.get(self.key_fn(key))
+        if entry is None:
+            return None
+        return entry[1] + entry[2] - time.time()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    async def lookup(self, key: Hashable) -> Any:
+        # Value from either tier, or from a fetch already in flight, without
+        # starting a fetch; None on a miss
+        key = self.key_fn(key)
+        found = self._lookup(key)
+        if found is not None:
+            self.stats["l1_hits"] += 1
+            return found[0]
+        if key in self._inflight:
+            try:
+                return await asyncio.shield(self._inflight[key])
+            except Exception:
+                return None
+        entry = (await self._backend_get([key])).get(key)
+        if entry is None or entry[1] + entry[2] < time.time():
+            self.stats["misses"] += 1
+            return None
+        self._entries[key] = entry
+        self.stats["l2_hits"] += 1
+        return entry[0]
+
+    async def set(self, key: Hashable, value: Any):
+        # Stores a value produced outside get_or_fetch in both tiers
+        key = self.key_fn(key)
+        entry = self._entry(key, value, time.time())
+        self._entries[key] = entry
+        await self._backend_set({key: entry})
+
+    def claim(self, key: Hashable) -> Optional[asyncio.Future]:
+        # Registers a value being produced outside get_or_fetch (a streamed
+        # response) so concurrent lookups and fetches wait for it instead of
+        # starting their own. None if the key is already in flight. The
+        # caller resolves the future with resolve().
+        key = self.key_fn(key)
+        if key in self._inflight:
+            return None
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        return future
+
+    async def resolve(self, key: Hashable, future: asyncio.Future, value: Any = None, error: Optional[BaseException] = None):
+        # Completes a claim: stores the value in both tiers and hands it to
+        # the waiters. A failed claim is abandoned rather than passed on, since
+        # the waiters never asked for the claimant's stream: they see a miss
+        # (KeyError, as for a key a batch fetch left out) and fetch it themselves.
+        key = self.key_fn(key)
+        if error is None:
+            await self.set(key, value)
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        if future.done():
+            return
+        if error is None:
+            future.set_result(value)
+        else:
+            logger.warning(f"{self.name}: claim on {key!r} abandoned: {error}")
+            future.set_exception(KeyError(key))
+            future.exception()  # waiters are optional; don't warn if there were none
+
+    def invalidate(self, key: Hashable):
+        # Drops the local copy only; the shared tier still expires by TTL
+        self._entries.pop(self.key_fn(key), None)
+
+    async def _backend_get(self, keys: List[Hashable]) -> Dict[Hashable, Entry]:
+        if self.backend is None:
+            return {}
+        try:
+            return await self.backend.get_many(keys)
+        except Exception as e:
+            self.stats["l2_errors"] += 1
+            logger.warning(f"{self.name}: shared cache read failed: {e}")
+            return {}
+
+    async def _backend_set(self, entries: Dict[Hashable, Entry]):
+        if self.backend is None or not entries:
+            return
+        try:
+            await self.backend.set_many(entries, self.stale_ttl)
+        except Exception as e:
+            self.stats["l2_errors"] += 1
+            logger.warning(f"{self.name}: shared cache write failed: {e}")
+
+    def _start(self, keys: List[Hashable], fetch_many: FetchMany, check_backend: bool = True) -> Dict[Hashable, asyncio.Future]:
+        loop = asyncio.get_running_loop()
+        futures = {key: loop.create_future() for key in keys}
+        self._inflight.update(futures)
+
+        async def run():
+            try:
+                pending = list(keys)
+                if check_backend:
+                    # Another worker may already hold these; stale shared entries
+                    # answer the waiters now and are refreshed below
+                    refetch = []
+                    now = time.time()
+                    for key, (value, fetched_at, ttl) in (await self._backend_get(pending)).items():
+                        if now - fetched_at >= ttl + self.stale_ttl:
+                            continue
+                        self._entries[key] = (value, fetched_at, ttl)
+                        self.stats["l2_hits"] += 1
+                        futures[key].set_result(value)
+                        if now - fetched_at >= ttl:
+                            refetch.append(key)
+                    pending = [key for key in pending if not futures[key].done()]
+                    self.stats["misses"] += len(pending)
+                    pending += refetch
+
+                if pending:
+                    values = await fetch_many(pending)
+                    fetched_at = time.time()
+                    fresh = {}
+                    for key in pending:
+                        if key in values:
+                            entry = self._entry(key, values[key], fetched_at)
+                            self._entries[key] = entry
+                            fresh[key] = entry
+                            if not futures[key].done():
+                                futures[key].set_result(values[key])
+                        elif not futures[key].done():
+                            futures[key].set_exception(KeyError(key))
+                    await self._backend_set(fresh)
+            except asyncio.CancelledError:
+                for future in futures.values():
+                    future.cancel()
+                raise
+            except Exception as e:
+                for future in futures.values():
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                for key, future in futures.items():
+                    if self._inflight.get(key) is future:
+                        del self._inflight[key]
+                    # Mark errors as retrieved; waiters still see them when awaiting
+                    if future.done() and not future.cancelled():
+                        future.exception()
+
+        task = asyncio.create_task(run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return futures
+
+    def _refresh(self, keys: List[Hashable], fetch_many: FetchMany):
+        # Background revalidation of stale keys that aren't already being fetched
+        keys = [key for key in keys if key not in self._inflight]
+        if not keys:
+            return
+        # The shared tier is checked first: another worker (or the background
+        # refresher) may already have a newer copy
+        for key, future in self._start(keys, fetch_many).items():
+            future.add_done_callback(partial(_log_refresh_error, key))
+
+    async def _await_all(self, waiting: Dict[Hashable, asyncio.Future]) -> Dict[Hashable, Any]:
+        # Shield so one caller going away doesn't cancel a shared fetch
+        resolved: Dict[Hashable, Any] = {}
+        outcomes = await asyncio.gather(
+            *(asyncio.shield(future) for future in waiting.values()),
+            return_exceptions=True,
+        )
+        for key, outcome in zip(waiting, outcomes):
+            if isinstance(outcome, KeyError):
+                continue
+            if isinstance(outcome, BaseException):
+                logger.warning(f"Fetch failed for {key!r}: {outcome}")
+                continue
+            resolved[key] = outcome
+        return resolved
+
+    async def refresh(self, keys: Iterable[Hashable], fetch_many: FetchMany) -> Dict[Hashable, Any]:
+        # Fetches the keys upstream now regardless of freshness (joining any
+        # fetch already in flight) and writes them through to both tiers
+        keys = list(dict.fromkeys(self.key_fn(key) for key in keys))
+        waiting = {key: self._inflight[key] for key in keys if key in self._inflight}
+        todo = [key for key in keys if key not in waiting]
+        if todo:
+            waiting.update(self._start(todo, fetch_many, check_backend=False))
+        return await self._await_all(waiting)
+
+    async def get_or_fetch(self, key: Hashable, fetch: Fetch) -> Any:
+        key = self.key_fn(key)
+
+        async def fetch_one(keys):
+            return {key: await fetch()}
+
+        found = self._lookup(key)
+        if found is not None:
+            value, fresh = found
+            self.stats["l1_hits"] += 1
+            if not fresh:
+                self.stats["stale_served"] += 1
+                self._refresh([key], fetch_one)
+            return value
+
+        # Shield so one caller going away doesn't cancel the shared fetch
+        future = self._inflight.get(key)
+        while future is not None:
+            try:
+                return await asyncio.shield(future)
+            except KeyError:
+                # Finished without this key (left out of a batch fetch, or an
+                # abandoned claim): join whoever fetches it next, else fetch it here
+                retry = self._inflight.get(key)
+                future = retry if retry is not future else None
+
+        future = self._start([key], fetch_one)[key]
+        return await asyncio.shield(future)
+
+    async def get_many(self, keys: Iterable[Hashable], fetch_many: FetchMany) -> Dict[Hashable, Any]:
+        # Returns {key: value} (keyed as passed in) for every key that could be
+        # resolved; keys the fetch doesn't return (or that fail) are left out.
+        # fetch_many receives normalized keys.
+        originals: Dict[Hashable, List[Hashable]] = {}
+        for key in keys:
+            originals.setdefault(self.key_fn(key), []).append(key)
+
+        resolved: Dict[Hashable, Any] = {}
+        stale: List[Hashable] = []
+        waiting: Dict[Hashable, asyncio.Future] = {}
+        misses: List[Hashable] = []
+
+        for key in originals:
+            found = self._lookup(key)
+            if found is not None:
+                self.stats["l1_hits"] += 1
+                resolved[key] = found[0]
+                if not found[1]:
+                    self.stats["stale_served"] += 1
+                    stale.append(key)
+            elif key in self._inflight:
+                waiting[key] = self._inflight[key]
+            else:
+                misses.append(key)
+
+        if stale:
+            self._refresh(stale, fetch_many)
+        if misses:
+            waiting.update(self._start(misses, fetch_many))
+        if waiting:
+            resolved.update(await self._await_all(waiting))
+
+        return {
+            original: value
+            for key, value in resolved.items()
+            for original in originals[key]
+        }
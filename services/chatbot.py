@@ -1,9 +1,17 @@
-from anthropic import AsyncAnthropic
+from anthropic import APIStatusError, AsyncAnthropic
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
 import os
+import random
+import time
 from dotenv import load_dotenv
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator, Awaitable, Callable, Optional, Tuple
 from fastapi import HTTPException
 import logging
+from .cache import CoalescingCache, shared_backend
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -11,6 +19,151 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+MODEL = "claude-3-haiku-20240307"
+MAX_TOKENS = 1000
+
+# Chat history beyond this (rough) token budget is folded into a summary.
+# Older turns are summarized in fixed-size chunks so the summarized prefix,
+# and therefore its cache key, stays the same from one turn to the next.
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))
+HISTORY_SUMMARY_CHUNK = int(os.getenv("HISTORY_SUMMARY_CHUNK", "8"))
+SUMMARY_MAX_TOKENS = 300
+SUMMARY_CACHE_TTL = int(os.getenv("SUMMARY_CACHE_TTL", "86400"))
+
+# The API only caches a prompt prefix at least this long (the model's
+# minimum); the system prompt alone is far shorter, so the cache breakpoint
+# goes after the conversation so far once that is long enough
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "2048"))
+
+summary_cache = CoalescingCache(
+    "history_summary", maxsize=1000, ttl=SUMMARY_CACHE_TTL, backend=shared_backend("history_summary")
+)
+
+
+def _estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough for budgeting
+    return len(text) // 4 + 1
+
+
+# Admission control for model calls, shared by every ChatGPT instance
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "8"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "50"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_RETRY_BASE = float(os.getenv("LLM_RETRY_BASE", "0.5"))
+LLM_RETRY_CAP = float(os.getenv("LLM_RETRY_CAP", "8"))
+
+# Rate limited and overloaded
+RETRY_STATUS_CODES = {429, 529}
+
+# Lower runs first
+PRIORITY_CHAT = 0
+PRIORITY_ANALYSIS = 1
+PRIORITY_BACKGROUND = 2
+
+
+class LLMDispatcher:
+    # Caps concurrent model calls. Callers beyond the cap wait in a bounded
+    # priority queue (interactive chat ahead of background work); once the
+    # queue is full new calls are rejected with a 503 straight away instead of
+    # piling up behind upstream rate limits.
+    def __init__(self, max_in_flight: int = LLM_MAX_IN_FLIGHT, max_queue: int = LLM_MAX_QUEUE):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self._queue: List = []
+        self._order = itertools.count()
+        self.stats = {
+            "admitted": 0,
+            "queued": 0,
+            "waited": 0,
+            "rejected": 0,
+            "retries": 0,
+            "total_wait_ms": 0.0,
+            "max_wait_ms": 0.0,
+        }
+
+    async def acquire(self, priority: int = PRIORITY_ANALYSIS):
+        if self.in_flight < self.max_in_flight and not self._queue:
+            self.in_flight += 1
+            self.stats["admitted"] += 1
+            return
+        if len(self._queue) >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise HTTPException(
+                status_code=503,
+                detail="AI service is busy, please try again shortly",
+                headers={"Retry-After": "5"}
+            )
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._order), waiter))
+        self.stats["queued"] += 1
+        started = time.monotonic()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the caller went away
+                self.release()
+            else:
+                self._queue = [item for item in self._queue if item[2] is not waiter]
+                heapq.heapify(self._queue)
+            raise
+        waited = (time.monotonic() - started) * 1000
+        self.stats["admitted"] += 1
+        self.stats["waited"] += 1
+        self.stats["total_wait_ms"] += waited
+        self.stats["max_wait_ms"] = max(self.stats["max_wait_ms"], waited)
+
+    def release(self):
+        # Hands the slot straight to the highest-priority waiter, if any
+        while self._queue:
+            _, _, waiter = heapq.heappop(self._queue)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    async def backoff(self, attempt: int, error: APIStatusError):
+        retry_after = error.response.headers.get("retry-after") if error.response is not None else None
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = random.uniform(0, min(LLM_RETRY_CAP, LLM_RETRY_BASE * 2 ** attempt))
+        self.stats["retries"] += 1
+        logger.warning(f"Anthropic returned {error.status_code}, retrying in {delay:.2f}s")
+        await asyncio.sleep(min(delay, LLM_RETRY_CAP))
+
+    async def run(self, call: Callable[[], Awaitable[Any]], priority: int = PRIORITY_ANALYSIS) -> Any:
+        # Runs call in a slot, retrying rate-limit/overload errors with backoff
+        await self.acquire(priority)
+        try:
+            for attempt in range(LLM_MAX_RETRIES + 1):
+                try:
+                    return await call()
+                except APIStatusError as e:
+                    if e.status_code not in RETRY_STATUS_CODES or attempt == LLM_MAX_RETRIES:
+                        raise
+                    await self.backoff(attempt, e)
+        finally:
+            self.release()
+
+    def snapshot_stats(self) -> Dict[str, Any]:
+        waited = self.stats["waited"]
+        return {
+            **self.stats,
+            "total_wait_ms": round(self.stats["total_wait_ms"], 1),
+            "max_wait_ms": round(self.stats["max_wait_ms"], 1),
+            "in_flight": self.in_flight,
+            "queue_depth": len(self._queue),
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "avg_wait_ms": round(self.stats["total_wait_ms"] / waited, 1) if waited else 0.0,
+        }
+
+
+llm_dispatcher = LLMDispatcher()
+
 class ChatGPT:
     def __init__(self):
         api_key = os.getenv("ANTHROPIC_API_KEY")
@@ -19,7 +172,8 @@ class ChatGPT:
             logger.error("Anthropic API key not found in environment variables")
             raise ValueError("Anthropic API key not configured")
             
-        self.client = AsyncAnthropic(api_key=api_key)
+        # Retries are handled by the dispatcher so they count against its slots
+        self.client = AsyncAnthropic(api_key=api_key, max_retries=0)
         self.system_prompt = """You are an expert financial advisor chatbot. Your responsibilities include:
         - Analyzing market trends and stock performance
         - Providing investment strategies and portfolio advice
@@ -33,22 +187,25 @@ class ChatGPT:
         Always consider risk factors and include relevant disclaimers when giving financial advice.
         """
     
-    async def _get_response(self, user_message: str, chat_history: List[Dict[str, Any]] | None = None) -> str:
+    async def _get_response(
+        self,
+        user_message: str,
+        chat_history: List[Dict[str, Any]] | None = None,
+        priority: int = PRIORITY_ANALYSIS
+    ) -> str:
         try:
             logger.info(f"Generating response for message: {user_message[:100]}...")  # Log first 100 chars
             
-            # Build the complete message with system prompt, chat history, and user message
-            complete_message = self._build_message(user_message, chat_history)
+            # System prompt plus role-tagged (and compacted) history
+            system, messages = await self._build_messages(user_message, chat_history, priority)
             logger.info("Built message structure")
             
-            response = await self.client.messages.create(
-                model="claude-3-haiku-20240307",
-                max_tokens=1000,
-                messages=[{
-                    "role": "user",
-                    "content": complete_message
-                }]
-            )
+            response = await llm_dispatcher.run(lambda: self.client.messages.create(
+                model=MODEL,
+                max_tokens=MAX_TOKENS,
+                system=system,
+                messages=messages
+            ), priority)
             
             if not response.content:
                 logger.error("No content in response from Claude")
@@ -59,6 +216,8 @@ class ChatGPT:
             
             return content
             
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"Error in _get_response: {str(e)}", exc_info=True)
             raise HTTPException(
@@ -66,26 +225,143 @@ class ChatGPT:
                 detail=f"Failed to generate analysis: {str(e)}"
             )
     
-    def _build_message(self, user_message: str, chat_history: List[Dict[str, Any]] | None = None) -> str:
+    async def _stream_response(
+        self,
+        user_message: str,
+        chat_history: List[Dict[str, Any]] | None = None,
+        priority: int = PRIORITY_ANALYSIS
+    ) -> AsyncIterator[str]:
+        # Same request as _get_response, yielding text as it is generated. The
+        # dispatcher slot is held for the whole stream; rate-limit errors are
+        # only retried before any text has been sent.
+        logger.info(f"Streaming response for message: {user_message[:100]}...")
+        system, messages = await self._build_messages(user_message, chat_history, priority)
+
+        length = 0
+        await llm_dispatcher.acquire(priority)
         try:
-            # Start with the system prompt
-            complete_message = self.system_prompt + "\n\n"
-            
-            # Add chat history if provided
-            if chat_history:
-                # Only keep last 5 messages to maintain context without exceeding limits
-                for msg in chat_history[-5:]:
-                    if isinstance(msg, dict) and "role" in msg and "content" in msg:
-                        role = "Human:" if msg["role"] == "user" else "Assistant:"
-                        complete_message += f"{role} {msg['content']}\n\n"
-            
-            # Add the current user message
-            complete_message += f"Human: {user_message}\n\nAssistant:"
-            return complete_message
-            
+            for attempt in range(LLM_MAX_RETRIES + 1):
+                try:
+                    async with self.client.messages.stream(
+                        model=MODEL,
+                        max_tokens=MAX_TOKENS,
+                        system=system,
+                        messages=messages
+                    ) as stream:
+                        async for text in stream.text_stream:
+                            length += len(text)
+                            yield text
+                    break
+                except APIStatusError as e:
+                    if length or e.status_code not in RETRY_STATUS_CODES or attempt == LLM_MAX_RETRIES:
+                        raise
+                    await llm_dispatcher.backoff(attempt, e)
+        finally:
+            llm_dispatcher.release()
+        logger.info(f"Finished streaming response of length {length}")
+    
+    async def _summarize(self, previous: str, turns: List[Dict[str, str]], priority: int) -> str:
+        # Folds a chunk of older turns into the running summary
+        transcript = "\n\n".join(f"{msg['role'].title()}: {msg['content']}" for msg in turns)
+        prompt = (
+            "Update the summary of this conversation between a user and a financial advisor "
+            "with the new turns below. Keep symbols, figures, holdings and any advice given; "
+            "drop pleasantries. Reply with the summary only.\n\n"
+            f"Summary so far:\n{previous or '(none)'}\n\nNew turns:\n{transcript}"
+        )
+        response = await llm_dispatcher.run(lambda: self.client.messages.create(
+            model=MODEL,
+            max_tokens=SUMMARY_MAX_TOKENS,
+            messages=[{"role": "user", "content": prompt}]
+        ), priority)
+        return response.content[0].text if response.content else previous
+
+    async def _history_summary(self, turns: List[Dict[str, str]], priority: int) -> str:
+        # Summary of turns (a whole number of chunks), built chunk by chunk so
+        # each step is cached and reused as the conversation grows
+        if not turns:
+            return ""
+        key = hashlib.sha256(json.dumps(turns, sort_keys=True).encode()).hexdigest()
+
+        async def fetch():
+            previous = await self._history_summary(turns[:-HISTORY_SUMMARY_CHUNK], priority)
+            return await self._summarize(previous, turns[-HISTORY_SUMMARY_CHUNK:], priority)
+
+        return await summary_cache.get_or_fetch(key, fetch)
+
+    async def _build_messages(
+        self,
+        user_message: str,
+        chat_history: List[Dict[str, Any]] | None = None,
+        priority: int = PRIORITY_ANALYSIS
+    ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        try:
+            system = [{"type": "text", "text": self.system_prompt}]
+
+            turns = [
+                {"role": msg["role"], "content": str(msg["content"])}
+                for msg in chat_history or []
+                if isinstance(msg, dict) and msg.get("role") in ("user", "assistant") and msg.get("content")
+            ]
+
+            # Keep the most recent turns that fit the budget verbatim; older
+            # ones are summarized in whole chunks
+            used = _estimate_tokens(user_message)
+            keep_from = len(turns)
+            while keep_from > 0:
+                cost = _estimate_tokens(turns[keep_from - 1]["content"])
+                if used + cost > HISTORY_TOKEN_BUDGET:
+                    break
+                used += cost
+                keep_from -= 1
+            split = keep_from // HISTORY_SUMMARY_CHUNK * HISTORY_SUMMARY_CHUNK
+
+            try:
+                summary = await self._history_summary(turns[:split], priority)
+            except Exception as e:
+                # Answer from the recent turns alone rather than fail the request
+                logger.warning(f"History summary failed, dropping older turns: {e}")
+                summary = ""
+            if summary:
+                system.append({"type": "text", "text": f"Summary of the earlier conversation:\n{summary}"})
+
+            # The API wants alternating roles starting with the user
+            messages: List[Dict[str, Any]] = []
+            for turn in turns[split:] + [{"role": "user", "content": user_message}]:
+                if not messages and turn["role"] != "user":
+                    continue
+                if messages and messages[-1]["role"] == turn["role"]:
+                    messages[-1]["content"] += "\n\n" + turn["content"]
+                else:
+                    messages.append(dict(turn))
+
+            # System prompt, summary and verbatim turns only change at chunk
+            # boundaries, so the next message in the conversation can read
+            # everything before this one from the cache
+            if len(messages) > 1:
+                prefix = sum(_estimate_tokens(block["text"]) for block in system)
+                prefix += sum(_estimate_tokens(msg["content"]) for msg in messages[:-1])
+                if prefix >= PROMPT_CACHE_MIN_TOKENS:
+                    last = messages[-2]
+                    last["content"] = [{"type": "text", "text": last["content"], "cache_control": {"type": "ephemeral"}}]
+            return system, messages
+
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"Error building message: {str(e)}", exc_info=True)
             raise HTTPException(
                 status_code=500,
                 detail=f"Error building message structure: {str(e)}"
             )
+
+
+_chatgpt: Optional[ChatGPT] = None
+
+
+def get_chatgpt() -> ChatGPT:
+    # One service instance (and HTTP connection pool) per process
+    global _chatgpt
+    if _chatgpt is None:
+        _chatgpt = ChatGPT()
+    return _chatgpt
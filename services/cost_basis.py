@@ -0,0 +1,160 @@
+import argparse
+import asyncio
+import os
+from datetime import datetime
+from typing import Dict, Iterable, List
+
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel
+
+from ..database import close_connection, db, ensure_indexes, register_indexes, trades, users
+
+# Open lots and running totals per user per position: {user_id, symbol,
+# lots: [[quantity, unit_cost], ...] oldest first, quantity, cost (basis of
+# the open quantity), realized, invested (everything ever paid in), updated_at}.
+# Option positions use the same key as the user's options map.
+cost_basis = db.cost_basis
+register_indexes("cost_basis", IndexModel([("user_id", ASCENDING), ("symbol", ASCENDING)], unique=True))
+
+# "fifo" sells the oldest lots first; "average" keeps one lot at the mean cost
+COST_BASIS_METHOD = os.getenv("COST_BASIS_METHOD", "fifo").lower()
+
+# Lots smaller than this are rounding leftovers
+_EPSILON = 1e-9
+
+
+def empty_position() -> Dict:
+    return {"lots": [], "quantity": 0.0, "cost": 0.0, "realized": 0.0, "invested": 0.0}
+
+
+def apply_trade(position: Dict, side: str, quantity: float, total_cost: float, method: str = COST_BASIS_METHOD) -> Dict:
+    # Returns the position after one trade. Shares sold beyond the tracked
+    # lots (held from before the ledger) have no known cost and realize nothing.
+    lots = [list(lot) for lot in position["lots"]]
+    realized = position["realized"]
+    invested = position["invested"]
+    quantity = float(quantity)
+    total_cost = float(total_cost)
+
+    if side == "BUY":
+        invested += total_cost
+        if method == "average" and lots:
+            held = sum(q for q, _ in lots)
+            lots = [[held + quantity, (sum(q * c for q, c in lots) + total_cost) / (held + quantity)]]
+        else:
+            lots.append([quantity, total_cost / quantity if quantity else 0.0])
+    else:
+        unit_price = total_cost / quantity if quantity else 0.0
+        remaining = quantity
+        while remaining > _EPSILON and lots:
+            lot = lots[0]
+            matched = min(lot[0], remaining)
+            realized += matched * (unit_price - lot[1])
+            lot[0] -= matched
+            remaining -= matched
+            if lot[0] <= _EPSILON:
+                lots.pop(0)
+
+    return {
+        "lots": lots,
+        "quantity": sum(q for q, _ in lots),
+        "cost": sum(q * c for q, c in lots),
+        "realized": realized,
+        "invested": invested,
+    }
+
+
+async def record_trade(user_id: str, symbol: str, side: str, quantity: float, total_cost: float, session=None):
+    # Folds one trade into the stored position; called inside the trade's
+    # transaction so the lots never disagree with the ledger
+    key = {"user_id": user_id, "symbol": symbol}
+    stored = await cost_basis.find_one(key, session=session)
+    position = apply_trade(stored or empty_position(), side, quantity, total_cost)
+    await cost_basis.update_one(
+        key,
+        {"$set": {**position, "updated_at": datetime.utcnow()}},
+        upsert=True,
+        session=session,
+    )
+
+
+async def get_positions(user_id: str) -> Dict[str, Dict]:
+    cursor = cost_basis.find(
+        {"user_id": user_id},
+        {"_id": 0, "symbol": 1, "quantity": 1, "cost": 1, "realized": 1, "invested": 1},
+    )
+    return {doc["symbol"]: doc async for doc in cursor}
+
+
+def gain_loss(positions: Dict[str, Dict], portfolio: Dict[str, float], quotes: Dict[str, Dict]) -> Dict:
+    # Realized P&L comes straight from the stored state; unrealized marks the
+    # tracked lots of each quoted share position to the current price.
+    # Options have no live price and are carried at cost.
+    realized = sum(float(p.get("realized", 0)) for p in positions.values())
+    invested = sum(float(p.get("invested", 0)) for p in positions.values())
+    unrealized = 0.0
+    for symbol, p in positions.items():
+        held = float(portfolio.get(symbol, 0) or 0)
+        if symbol not in quotes or held <= 0:
+            continue
+        tracked = min(float(p.get("quantity", 0)), held)
+        if tracked > 0:
+            unrealized += tracked * float(quotes[symbol]["price"]) - float(p["cost"]) * tracked / float(p["quantity"])
+    total = realized + unrealized
+    return {
+        "realized_gains": realized,
+        "unrealized_gains": unrealized,
+        "total_gain_loss": total,
+        "total_invested": invested,
+        "total_gain_loss_percentage": total / invested * 100 if invested > 0 else 0.0,
+    }
+
+
+def _position_key(trade: Dict) -> str:
+    if "option_type" in trade:
+        return f"{trade['symbol']}-{trade['option_type']}-{trade['strike']}-{trade['expiration']}"
+    return trade["symbol"]
+
+
+async def rebuild(user_ids: Iterable[str]) -> int:
+    # Replays the ledger into fresh state; for backfilling users whose trades
+    # predate the engine, or after changing COST_BASIS_METHOD
+    count = 0
+    for user_id in user_ids:
+        positions: Dict[str, Dict] = {}
+        cursor = trades.find({"user_id": ObjectId(user_id)}).sort("timestamp", ASCENDING)
+        async for trade in cursor:
+            key = _position_key(trade)
+            positions[key] = apply_trade(
+                positions.get(key, empty_position()),
+                trade["trade_type"],
+                trade["quantity"],
+                trade["total_cost"],
+            )
+        now = datetime.utcnow()
+        await cost_basis.delete_many({"user_id": user_id})
+        if positions:
+            await cost_basis.insert_many([
+                {"user_id": user_id, "symbol": key, **position, "updated_at": now}
+                for key, position in positions.items()
+            ])
+        count += 1
+    return count
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description="Rebuild stored cost basis from the trade ledger")
+    parser.add_argument("user_ids", nargs="*", help="Users to rebuild (default: all)")
+    args = parser.parse_args()
+
+    try:
+        await ensure_indexes()
+        user_ids: List[str] = args.user_ids or [str(u["_id"]) async for u in users.find({}, {"_id": 1})]
+        count = await rebuild(user_ids)
+        print(f"Rebuilt cost basis for {count} users")
+    finally:
+        await close_connection()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,159 @@
+import asyncio
+import csv
+import io
+import json
+import os
+import tempfile
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import ASCENDING
+
+from ..database import trades
+from .snapshots import portfolio_snapshots
+
+# Documents fetched from the server-side cursor per round trip, and rows per
+# parquet row group
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+# Text output is flushed to the client in chunks of about this many bytes
+EXPORT_CHUNK_BYTES = int(os.getenv("EXPORT_CHUNK_BYTES", "65536"))
+
+# Column name -> type, in output order
+TRADE_COLUMNS = {
+    "id": "string",
+    "timestamp": "timestamp",
+    "trade_type": "string",
+    "symbol": "string",
+    "quantity": "float",
+    "price": "float",
+    "total_cost": "float",
+    "option_type": "string",
+    "strike": "float",
+    "expiration": "string",
+    "premium": "float",
+}
+HISTORY_COLUMNS = {
+    "date": "string",
+    "value": "float",
+    "cash": "float",
+    "positions_value": "float",
+}
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def _trade_documents(user_id: str) -> AsyncIterator[Dict]:
+    projection = {column: 1 for column in TRADE_COLUMNS if column != "id"}
+    return trades.find({"user_id": ObjectId(user_id)}, projection).sort(
+        [("timestamp", ASCENDING), ("_id", ASCENDING)]
+    ).batch_size(EXPORT_BATCH_SIZE)
+
+
+def _history_documents(user_id: str) -> AsyncIterator[Dict]:
+    projection = {"_id": 0, **{column: 1 for column in HISTORY_COLUMNS}}
+    return portfolio_snapshots.find({"user_id": user_id}, projection).sort(
+        "date", ASCENDING
+    ).batch_size(EXPORT_BATCH_SIZE)
+
+
+DATASETS = {
+    "trades": (_trade_documents, TRADE_COLUMNS),
+    "history": (_history_documents, HISTORY_COLUMNS),
+}
+
+
+def _row(doc: Dict, columns: Dict[str, str]) -> Dict:
+    row = {}
+    for column, kind in columns.items():
+        value = doc.get("_id") if column == "id" else doc.get(column)
+        if value is None or kind == "timestamp":
+            row[column] = value
+        elif kind == "float":
+            row[column] = float(value)
+        else:
+            row[column] = str(value)
+    return row
+
+
+def _text(value) -> Optional[str]:
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+async def _ndjson(docs: AsyncIterator[Dict], columns: Dict[str, str]) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    async for doc in docs:
+        row = _row(doc, columns)
+        buffer.write(json.dumps({k: _text(v) for k, v in row.items()}, separators=(",", ":")))
+        buffer.write("\n")
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue().encode()
+            buffer = io.StringIO()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+async def _csv(docs: AsyncIterator[Dict], columns: Dict[str, str]) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    async for doc in docs:
+        writer.writerow(_text(v) for v in _row(doc, columns).values())
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+async def _parquet(docs: AsyncIterator[Dict], columns: Dict[str, str]) -> AsyncIterator[bytes]:
+    # Row groups are written to a temporary file as batches arrive (the
+    # footer only exists once the last one is written), then the file is
+    # streamed back. Memory stays at one batch either way.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {"string": pa.string(), "float": pa.float64(), "timestamp": pa.timestamp("ms")}
+    schema = pa.schema([(column, types[kind]) for column, kind in columns.items()])
+
+    with tempfile.TemporaryFile() as spool:
+        writer = pq.ParquetWriter(spool, schema)
+        try:
+            batch: List[Dict] = []
+            async for doc in docs:
+                batch.append(_row(doc, columns))
+                if len(batch) >= EXPORT_BATCH_SIZE:
+                    await asyncio.to_thread(writer.write_table, pa.Table.from_pylist(batch, schema=schema))
+                    batch = []
+            if batch:
+                await asyncio.to_thread(writer.write_table, pa.Table.from_pylist(batch, schema=schema))
+        finally:
+            await asyncio.to_thread(writer.close)
+
+        spool.seek(0)
+        while True:
+            chunk = await asyncio.to_thread(spool.read, EXPORT_CHUNK_BYTES)
+            if not chunk:
+                break
+            yield chunk
+
+
+def parquet_supported() -> bool:
+    try:
+        import pyarrow.parquet  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def export_stream(dataset: str, user_id: str, fmt: str) -> AsyncIterator[bytes]:
+    # Streams one user's trades or portfolio history in the given format,
+    # reading the collection through a server-side cursor in batches
+    documents, columns = DATASETS[dataset]
+    encoder = {"ndjson": _ndjson, "csv": _csv, "parquet": _parquet}[fmt]
+    return encoder(documents(user_id), columns)
@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Dict, Optional, Set
+
+from bson import ObjectId
+
+from ..database import db, users
+from .chatbot import PRIORITY_BACKGROUND, get_chatgpt
+from .trading import option_holdings
+
+logger = logging.getLogger(__name__)
+
+# Latest generated insights per user: {_id: user_id, insights, composition_hash, generated_at}
+portfolio_insights = db.portfolio_insights
+
+# Cash moves smaller than this don't count as a material change
+INSIGHTS_CASH_STEP = float(os.getenv("INSIGHTS_CASH_STEP", "500"))
+# Trades in quick succession are folded into one regeneration
+INSIGHTS_DEBOUNCE = float(os.getenv("INSIGHTS_DEBOUNCE", "5"))
+
+FALLBACK_INSIGHTS = {
+    "risk_level": "Moderate",
+    "health_score": 70,
+    "health_rating": "Good",
+    "recommendations": [
+        {
+            "title": "Regular Review",
+            "description": "Schedule periodic portfolio reviews"
+        }
+    ]
+}
+
+_pending: Set[str] = set()
+_tasks: Set[asyncio.Task] = set()
+
+
+def _positions(user: Dict):
+    # Stored positions if present, otherwise the share holdings
+    return user.get("positions") or [
+        {"symbol": symbol, "quantity": float(qty)}
+        for symbol, qty in sorted(user.get("portfolio", {}).items())
+        if float(qty) > 0
+    ]
+
+
+def composition_hash(user: Dict) -> str:
+    # Changes only when holdings change or cash moves by a full step
+    composition = {
+        "portfolio": {symbol: round(float(qty), 4) for symbol, qty in user.get("portfolio", {}).items() if float(qty) > 0},
+        "options": {key: round(qty, 4) for key, qty in option_holdings(user).items()},
+        "positions": user.get("positions", []),
+        "cash": round(float(user.get("cash", 0) or 0) / INSIGHTS_CASH_STEP),
+        "total_value": round(float(user.get("total_value", 0) or 0) / INSIGHTS_CASH_STEP),
+    }
+    canonical = json.dumps(composition, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _insights_prompt(user: Dict) -> str:
+    total_value = float(user.get("total_value", 0) or 0)
+    cash = float(user.get("cash", 0) or 0)
+    return f"""
+        Analyze this investment portfolio and provide insights:
+
+        Total Portfolio Value: ${total_value:,.2f}
+        Cash Position: ${cash:,.2f}
+
+        Current Positions:
+        {_positions(user)}
+
+        Provide a JSON response with the following structure:
+        {{
+            "risk_level": "Low" or "Moderate" or "High",
+            "health_score": number between 0-100,
+            "health_rating": descriptive rating of the health score,
+            "recommendations": [
+                {{
+                    "title": "brief title",
+                    "description": "detailed recommendation"
+                }},
+                ... (up to 3 recommendations)
+            ]
+        }}
+
+        Base the analysis on:
+        - Diversification
+        - Sector allocation
+        - Cash position
+        - Risk exposure
+        - Current market conditions
+        """
+
+
+async def generate_insights(user_id: str, user: Optional[Dict] = None, force: bool = False) -> Optional[Dict]:
+    # Regenerates a user's insights unless the stored ones already match the
+    # current composition. Returns the insights, or None if the user is gone.
+    if user is None:
+        user = await users.find_one({"_id": ObjectId(user_id)})
+        if not user:
+            return None
+
+    digest = composition_hash(user)
+    if not force:
+        stored = await portfolio_insights.find_one({"_id": user_id, "composition_hash": digest}, {"insights": 1})
+        if stored:
+            return stored["insights"]
+
+    response = await get_chatgpt()._get_response(_insights_prompt(user), [], priority=PRIORITY_BACKGROUND)
+    try:
+        insights = json.loads(response)
+    except json.JSONDecodeError:
+        # Not cached under this hash, so the next change (or request) tries again
+        logger.warning(f"Insights for {user_id} were not valid JSON, serving fallback")
+        return FALLBACK_INSIGHTS
+
+    await portfolio_insights.update_one(
+        {"_id": user_id},
+        {"$set": {"insights": insights, "composition_hash": digest, "generated_at": datetime.utcnow()}},
+        upsert=True
+    )
+    logger.info(f"Regenerated portfolio insights for {user_id}")
+    return insights
+
+
+def schedule_insights(user_id: str):
+    # Called after a user's holdings change; regeneration runs in the background
+    if user_id in _pending:
+        return
+    _pending.add(user_id)
+
+    async def run():
+        try:
+            await asyncio.sleep(INSIGHTS_DEBOUNCE)
+            _pending.discard(user_id)
+            await generate_insights(user_id)
+        except Exception as e:
+            logger.warning(f"Background insights generation failed for {user_id}: {e}")
+        finally:
+            _pending.discard(user_id)
+
+    task = asyncio.create_task(run())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def get_insights(user_id: str) -> Optional[Dict]:
+    # Stored insights are served straight away; if they no longer match the
+    # portfolio (a background run after a trade failed or was shed) a new
+    # run is scheduled. Users without stored insights get them on the spot.
+    user = await users.find_one({"_id": ObjectId(user_id)})
+    if not user:
+        return None
+    stored = await portfolio_insights.find_one({"_id": user_id}, {"insights": 1, "composition_hash": 1})
+    if stored:
+        if stored.get("composition_hash") != composition_hash(user):
+            schedule_insights(user_id)
+        return stored["insights"]
+    return await generate_insights(user_id, user)
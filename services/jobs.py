@@ -0,0 +1,208 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pymongo import IndexModel, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from ..database import db, register_indexes
+
+logger = logging.getLogger(__name__)
+
+# Long-running work (LLM analyses) submitted by one request and collected by
+# later ones: {_id: job id, kind, params, status, result, error, created_at,
+# started_at, finished_at, expires_at}. The id is a hash of kind + params, so
+# resubmitting identical work returns the existing job.
+jobs = db.jobs
+register_indexes(
+    "jobs",
+    IndexModel("expires_at", expireAfterSeconds=0),
+    IndexModel([("status", 1), ("created_at", 1)]),
+)
+
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "4"))
+# Finished jobs (and their results) are kept this long
+JOB_RESULT_TTL = timedelta(seconds=int(os.getenv("JOB_RESULT_TTL", "3600")))
+# Jobs never picked up are dropped after this long
+JOB_MAX_AGE = timedelta(seconds=int(os.getenv("JOB_MAX_AGE", "86400")))
+# A running job whose worker stopped renewing it is reclaimed after this long;
+# live workers renew every JOB_HEARTBEAT
+JOB_LEASE = timedelta(seconds=int(os.getenv("JOB_LEASE", "300")))
+JOB_HEARTBEAT = JOB_LEASE / 3
+# Workers also poll for jobs submitted to other processes
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "2"))
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+Handler = Callable[[Dict[str, Any]], Awaitable[Any]]
+_handlers: Dict[str, Handler] = {}
+
+
+def register_handler(kind: str, handler: Handler):
+    _handlers[kind] = handler
+
+
+def job_id(kind: str, params: Dict[str, Any]) -> str:
+    canonical = json.dumps({"kind": kind, "params": params}, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()[:32]
+
+
+def public_job(doc: Dict) -> Dict:
+    # Status view of a job, without params or result
+    return {
+        "job_id": doc["_id"],
+        "kind": doc["kind"],
+        "status": doc["status"],
+        "error": doc.get("error"),
+        "created_at": doc["created_at"].isoformat(),
+        "started_at": doc["started_at"].isoformat() if doc.get("started_at") else None,
+        "finished_at": doc["finished_at"].isoformat() if doc.get("finished_at") else None,
+    }
+
+
+async def submit_job(kind: str, params: Dict[str, Any]) -> Tuple[Dict, bool]:
+    # Returns (job, created). A live or finished job with the same kind and
+    # params is returned as-is; a failed one is queued again.
+    if kind not in _handlers:
+        raise ValueError(f"Unknown job kind: {kind}")
+    now = datetime.utcnow()
+    doc = {
+        "_id": job_id(kind, params),
+        "kind": kind,
+        "params": params,
+        "status": QUEUED,
+        "created_at": now,
+        "expires_at": now + JOB_MAX_AGE,
+    }
+    try:
+        await jobs.insert_one(doc)
+        job_workers.wake()
+        return doc, True
+    except DuplicateKeyError:
+        pass
+
+    retried = await jobs.find_one_and_update(
+        {"_id": doc["_id"], "status": FAILED},
+        {
+            "$set": {"status": QUEUED, "created_at": now, "expires_at": now + JOB_MAX_AGE},
+            "$unset": {"error": "", "started_at": "", "finished_at": "", "worker": ""},
+        },
+        return_document=ReturnDocument.AFTER,
+    )
+    if retried:
+        job_workers.wake()
+        return retried, True
+    existing = await jobs.find_one({"_id": doc["_id"]})
+    if existing is None:
+        # Expired between the insert and the read
+        return await submit_job(kind, params)
+    return existing, False
+
+
+async def get_job(job_id: str) -> Optional[Dict]:
+    return await jobs.find_one({"_id": job_id})
+
+
+class JobWorkers:
+    # A fixed pool of workers per process claiming queued jobs from Mongo
+    def __init__(self, concurrency: int = JOB_CONCURRENCY):
+        self.concurrency = concurrency
+        # Each worker coroutine claims under its own id, so a job reclaimed
+        # from one of them can't be finished by it as well
+        self.process_id = uuid.uuid4().hex
+        self._wake = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {"completed": 0, "failed": 0, "running": 0}
+
+    def wake(self):
+        self._wake.set()
+
+    async def _claim(self, worker_id: str) -> Optional[Dict]:
+        now = datetime.utcnow()
+        return await jobs.find_one_and_update(
+            {"$or": [
+                {"status": QUEUED},
+                {"status": RUNNING, "started_at": {"$lt": now - JOB_LEASE}},
+            ]},
+            {"$set": {"status": RUNNING, "started_at": now, "worker": worker_id}},
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def _heartbeat(self, job: Dict, worker_id: str):
+        # Renews the lease for as long as the job runs; stops once another
+        # worker has taken the job over
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT.total_seconds())
+            try:
+                result = await jobs.update_one(
+                    {"_id": job["_id"], "status": RUNNING, "worker": worker_id},
+                    {"$set": {"started_at": datetime.utcnow()}},
+                )
+                if result.matched_count == 0:
+                    return
+            except Exception as e:
+                logger.warning(f"Could not renew lease on job {job['_id']}: {e}")
+
+    async def _execute(self, job: Dict, worker_id: str):
+        self.stats["running"] += 1
+        heartbeat = asyncio.create_task(self._heartbeat(job, worker_id))
+        try:
+            handler = _handlers.get(job["kind"])
+            if handler is None:
+                raise ValueError(f"No handler for job kind {job['kind']}")
+            result = await handler(job["params"])
+            update = {"status": DONE, "result": result}
+            self.stats["completed"] += 1
+        except Exception as e:
+            detail = getattr(e, "detail", None) or str(e)
+            logger.warning(f"Job {job['_id']} ({job['kind']}) failed: {detail}")
+            update = {"status": FAILED, "error": detail}
+            self.stats["failed"] += 1
+        finally:
+            heartbeat.cancel()
+            self.stats["running"] -= 1
+        now = datetime.utcnow()
+        await jobs.update_one(
+            {"_id": job["_id"], "worker": worker_id},
+            {"$set": {**update, "finished_at": now, "expires_at": now + JOB_RESULT_TTL}},
+        )
+
+    async def _run(self, index: int):
+        worker_id = f"{self.process_id}:{index}"
+        while True:
+            try:
+                job = await self._claim(worker_id)
+            except Exception as e:
+                logger.warning(f"Job claim failed: {e}")
+                job = None
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._execute(job, worker_id)
+            except Exception as e:
+                # Left running; another worker reclaims it once the lease lapses
+                logger.warning(f"Could not record outcome of job {job['_id']}: {e}")
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._run(i)) for i in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+job_workers = JobWorkers()
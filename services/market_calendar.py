@@ -0,0 +1,153 @@
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from typing import Dict, Optional, Set, Tuple
+from zoneinfo import ZoneInfo
+
+# US equity (NYSE/Nasdaq) regular-session calendar. Holidays are derived from
+# the exchange's published rules, so no yearly table needs maintaining.
+MARKET_TZ = ZoneInfo("America/New_York")
+MARKET_OPEN = time(9, 30)
+MARKET_CLOSE = time(16, 0)
+EARLY_CLOSE = time(13, 0)
+
+# How long after the close upstream takes to publish a session's daily bar
+DAILY_BAR_DELAY = timedelta(minutes=20)
+
+
+def _nth_weekday(year: int, month: int, weekday: int, n: int) -> date:
+    # n-th given weekday of the month (n=-1 for the last one)
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+    return last - timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def _easter(year: int) -> date:
+    # Anonymous Gregorian algorithm
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+def _observed(d: date) -> date:
+    # Saturday holidays move to Friday, Sunday holidays to Monday
+    if d.weekday() == 5:
+        return d - timedelta(days=1)
+    if d.weekday() == 6:
+        return d + timedelta(days=1)
+    return d
+
+
+@lru_cache(maxsize=None)
+def holidays(year: int) -> Dict[date, str]:
+    days = {
+        _nth_weekday(year, 1, 0, 3): "Martin Luther King Jr. Day",
+        _nth_weekday(year, 2, 0, 3): "Presidents' Day",
+        _easter(year) - timedelta(days=2): "Good Friday",
+        _nth_weekday(year, 5, 0, -1): "Memorial Day",
+        _observed(date(year, 7, 4)): "Independence Day",
+        _nth_weekday(year, 9, 0, 1): "Labor Day",
+        _nth_weekday(year, 11, 3, 4): "Thanksgiving Day",
+        _observed(date(year, 12, 25)): "Christmas Day",
+    }
+    # The exchange doesn't close on Friday Dec 31 for a Saturday New Year's Day
+    new_year = date(year, 1, 1)
+    if new_year.weekday() != 5:
+        days[_observed(new_year)] = "New Year's Day"
+    if year >= 2022:
+        days[_observed(date(year, 6, 19))] = "Juneteenth"
+    return days
+
+
+@lru_cache(maxsize=None)
+def early_closes(year: int) -> Set[date]:
+    candidates = {
+        date(year, 7, 3),
+        _nth_weekday(year, 11, 3, 4) + timedelta(days=1),  # day after Thanksgiving
+        date(year, 12, 24),
+    }
+    return {d for d in candidates if d.weekday() < 5 and d not in holidays(year)}
+
+
+def is_trading_day(d: date) -> bool:
+    return d.weekday() < 5 and d not in holidays(d.year)
+
+
+def next_trading_day(d: date) -> date:
+    # First trading day strictly after d
+    d += timedelta(days=1)
+    while not is_trading_day(d):
+        d += timedelta(days=1)
+    return d
+
+
+def previous_trading_day(d: date) -> date:
+    # Last trading day strictly before d
+    d -= timedelta(days=1)
+    while not is_trading_day(d):
+        d -= timedelta(days=1)
+    return d
+
+
+def session_bounds(d: date) -> Tuple[datetime, datetime]:
+    # Regular-session open and close for a trading day, in market time
+    close = EARLY_CLOSE if d in early_closes(d.year) else MARKET_CLOSE
+    return (
+        datetime.combine(d, MARKET_OPEN, tzinfo=MARKET_TZ),
+        datetime.combine(d, close, tzinfo=MARKET_TZ),
+    )
+
+
+def _now(now: Optional[datetime]) -> datetime:
+    return (now or datetime.now(MARKET_TZ)).astimezone(MARKET_TZ)
+
+
+def is_open(now: Optional[datetime] = None) -> bool:
+    now = _now(now)
+    if not is_trading_day(now.date()):
+        return False
+    open_at, close_at = session_bounds(now.date())
+    return open_at <= now < close_at
+
+
+def next_open(now: Optional[datetime] = None) -> datetime:
+    now = _now(now)
+    today = now.date()
+    if is_trading_day(today) and now < session_bounds(today)[0]:
+        return session_bounds(today)[0]
+    return session_bounds(next_trading_day(today))[0]
+
+
+def next_close(now: Optional[datetime] = None) -> datetime:
+    now = _now(now)
+    today = now.date()
+    if is_trading_day(today) and now < session_bounds(today)[1]:
+        return session_bounds(today)[1]
+    return session_bounds(next_trading_day(today))[1]
+
+
+def next_transition(now: Optional[datetime] = None) -> datetime:
+    # Next moment the market opens or closes
+    return min(next_open(now), next_close(now))
+
+
+def last_completed_session(now: Optional[datetime] = None, grace: timedelta = timedelta(0)) -> date:
+    # Most recent trading day whose close (plus grace) has passed
+    now = _now(now)
+    d = now.date()
+    if not (is_trading_day(d) and session_bounds(d)[1] + grace <= now):
+        d = previous_trading_day(d)
+    return d
+
+
+def seconds_until(when: datetime, now: Optional[datetime] = None) -> float:
+    return max((when - _now(now)).total_seconds(), 0.0)
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+import random
+from typing import Any, Dict, Optional
+
+import httpx
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+POLYGON_API_KEY = os.getenv("POLYGON_API_KEY")
+if not POLYGON_API_KEY or POLYGON_API_KEY.strip() == "":
+    raise ValueError("POLYGON_API_KEY not set or is empty.")
+
+BASE_POLYGON_URL = "https://api.polygon.io"
+
+# Pool, timeout and retry settings (can be tuned per deployment via env)
+POLYGON_MAX_CONNECTIONS = int(os.getenv("POLYGON_MAX_CONNECTIONS", "50"))
+POLYGON_MAX_KEEPALIVE = int(os.getenv("POLYGON_MAX_KEEPALIVE", "20"))
+POLYGON_CONNECT_TIMEOUT = float(os.getenv("POLYGON_CONNECT_TIMEOUT", "2.0"))
+POLYGON_TIMEOUT = float(os.getenv("POLYGON_TIMEOUT", "5.0"))
+POLYGON_MAX_RETRIES = int(os.getenv("POLYGON_MAX_RETRIES", "2"))
+POLYGON_BACKOFF_BASE = 0.2
+POLYGON_BACKOFF_MAX = 3.0
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class PolygonClient:
+    def __init__(self, base_url: str = BASE_POLYGON_URL, api_key: str = POLYGON_API_KEY):
+        self.base_url = base_url
+        self.api_key = api_key
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Created lazily so the pool is bound to the running event loop
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                limits=httpx.Limits(
+                    max_connections=POLYGON_MAX_CONNECTIONS,
+                    max_keepalive_connections=POLYGON_MAX_KEEPALIVE,
+                ),
+                timeout=httpx.Timeout(POLYGON_TIMEOUT, connect=POLYGON_CONNECT_TIMEOUT),
+            )
+        return self._client
+
+    def _backoff(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        # Honour Retry-After on 429s, otherwise exponential backoff with full jitter
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    return min(float(retry_after), POLYGON_BACKOFF_MAX)
+                except ValueError:
+                    pass
+        return random.uniform(0, min(POLYGON_BACKOFF_MAX, POLYGON_BACKOFF_BASE * (2 ** attempt)))
+
+    async def get(
+        self,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        timeout: Optional[float] = None,
+    ) -> httpx.Response:
+        request_timeout = httpx.Timeout(timeout, connect=POLYGON_CONNECT_TIMEOUT) if timeout else None
+        attempt = 0
+        while True:
+            try:
+                if request_timeout:
+                    response = await self.client.get(path, params=params, timeout=request_timeout)
+                else:
+                    response = await self.client.get(path, params=params)
+            except httpx.TransportError as e:
+                if attempt >= POLYGON_MAX_RETRIES:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(f"Polygon request {path} failed ({e!r}), retrying in {delay:.2f}s")
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= POLYGON_MAX_RETRIES:
+                    return response
+                delay = self._backoff(attempt, response)
+                logger.warning(f"Polygon request {path} returned {response.status_code}, retrying in {delay:.2f}s")
+
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def get_json(
+        self,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        timeout: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        response = await self.get(path, params=params, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# Shared instance used by every route; closed from the app lifespan
+polygon = PolygonClient()
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Tuple
+
+import numpy as np
+from bson import ObjectId
+
+from ..database import trades
+from .bars import bar_dates, daily_bars
+from .market_calendar import MARKET_TZ
+from .trading import option_holdings
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_SYMBOL = "SPY"
+DEFAULT_LOOKBACK_DAYS = 365
+
+
+def timeframe_start(timeframe: str, today: date, first_trade: date = None) -> date:
+    if timeframe == "1M":
+        return today - timedelta(days=30)
+    if timeframe == "3M":
+        return today - timedelta(days=90)
+    if timeframe == "YTD":
+        return date(today.year, 1, 1)
+    # ALL: since the first recorded trade, or a year when there is none
+    return first_trade or today - timedelta(days=DEFAULT_LOOKBACK_DAYS)
+
+
+def _trade_day(timestamp: datetime) -> date:
+    # Ledger timestamps are naive UTC; sessions are dated in market time
+    return timestamp.replace(tzinfo=timezone.utc).astimezone(MARKET_TZ).date()
+
+
+def _option_key(trade: Dict) -> str:
+    # Same contract key as option_holdings() returns
+    return f"{trade['symbol']}-{trade['option_type']}-{trade['strike']}-{trade['expiration']}"
+
+
+async def _load_ledger(user_id: str) -> List[Dict]:
+    cursor = trades.find(
+        {"user_id": ObjectId(user_id)},
+        {"_id": 0, "symbol": 1, "trade_type": 1, "quantity": 1, "total_cost": 1, "timestamp": 1,
+         "option_type": 1, "strike": 1, "expiration": 1},
+    ).sort("timestamp", 1)
+    return await cursor.to_list(length=None)
+
+
+def _aligned_closes(bars: np.ndarray, axis: np.ndarray) -> np.ndarray:
+    # Close on or before each axis date (carried forward over gaps), 0 before the first bar
+    if len(bars) == 0:
+        return np.zeros(len(axis))
+    idx = np.searchsorted(bar_dates(bars), axis, side="right") - 1
+    closes = np.asarray(bars["c"], dtype=float)[np.clip(idx, 0, None)]
+    closes[idx < 0] = 0.0
+    return closes
+
+
+async def performance_series(user: Dict, timeframe: str) -> Dict:
+    # Rebuilds the daily portfolio value over the timeframe from the trade
+    # ledger and stored daily closes, and compares it with the benchmark.
+    #
+    # Positions are anchored on the user's current holdings and walked
+    # backwards through the ledger, so holdings from before the ledger
+    # existed count as held throughout. Options have no price history and are
+    # carried at their average entry cost per contract.
+    ledger = await _load_ledger(str(user["_id"]))
+    today = datetime.now(MARKET_TZ).date()
+    first_trade = _trade_day(ledger[0]["timestamp"]) if ledger else None
+    start = timeframe_start(timeframe, today, first_trade)
+
+    benchmark = await daily_bars.get_range(BENCHMARK_SYMBOL, start, today)
+    if len(benchmark) == 0:
+        return {"labels": [], "portfolio": [], "benchmark": []}
+    axis = bar_dates(benchmark)
+
+    # Instruments: stocks priced from the bar store, option contracts at cost
+    holdings: Dict[str, float] = {
+        symbol: float(qty) for symbol, qty in user.get("portfolio", {}).items() if float(qty) > 0
+    }
+    options = option_holdings(user)
+    option_cost: Dict[str, Tuple[float, float]] = {}  # key -> (contracts bought, total paid)
+    for trade in ledger:
+        if "option_type" in trade:
+            key = _option_key(trade)
+            options.setdefault(key, 0.0)
+            if trade.get("trade_type") == "BUY":
+                bought, paid = option_cost.get(key, (0.0, 0.0))
+                option_cost[key] = (bought + float(trade["quantity"]), paid + float(trade["total_cost"]))
+        else:
+            holdings.setdefault(trade["symbol"], 0.0)
+
+    stocks = list(holdings)
+    contracts = list(options)
+    instruments = stocks + contracts
+    index = {name: i for i, name in enumerate(instruments)}
+
+    # Trade deltas bucketed by the first session on/after the trade date;
+    # column len(axis) holds trades after the last close in range
+    deltas = np.zeros((len(instruments), len(axis) + 1))
+    cash_flows = np.zeros(len(axis) + 1)
+    if ledger:
+        days = np.array([_trade_day(t["timestamp"]) for t in ledger], dtype="datetime64[D]")
+        cols = np.searchsorted(axis, days, side="left")
+        signs = np.array([1.0 if t.get("trade_type") == "BUY" else -1.0 for t in ledger])
+        quantities = np.array([float(t.get("quantity", 0)) for t in ledger])
+        costs = np.array([float(t.get("total_cost", 0)) for t in ledger])
+        rows = np.array([index[_option_key(t) if "option_type" in t else t["symbol"]] for t in ledger])
+        np.add.at(deltas, (rows, cols), signs * quantities)
+        np.add.at(cash_flows, cols, -signs * costs)
+
+    # Quantity at each close = current quantity minus everything traded after it
+    current = np.array([holdings[s] for s in stocks] + [options[k] for k in contracts])
+    cumulative = np.cumsum(deltas, axis=1)
+    quantities = current[:, None] - (cumulative[:, -1:] - cumulative[:, :-1])
+    flows = np.cumsum(cash_flows)
+    cash = float(user.get("cash", 0) or 0) - (flows[-1] - flows[:-1])
+
+    # Price matrix: stock closes from the local bar store, options at cost
+    stock_bars = await asyncio.gather(
+        *(daily_bars.get_range(symbol, start, today) for symbol in stocks), return_exceptions=True
+    )
+    prices = np.zeros((len(instruments), len(axis)))
+    for i, bars in enumerate(stock_bars):
+        if isinstance(bars, Exception):
+            logger.warning(f"No price history for {stocks[i]}: {bars}")
+            continue
+        prices[i] = _aligned_closes(bars, axis)
+    for j, key in enumerate(contracts):
+        bought, paid = option_cost.get(key, (0.0, 0.0))
+        prices[len(stocks) + j] = paid / bought if bought else 0.0
+
+    values = cash + (quantities * prices).sum(axis=0)
+    base = values[0] if values[0] else 1.0
+    portfolio_returns = (values / base - 1) * 100
+    closes = np.asarray(benchmark["c"], dtype=float)
+    benchmark_returns = (closes / closes[0] - 1) * 100
+
+    return {
+        "labels": [str(d) for d in axis],
+        "portfolio": np.round(portfolio_returns, 2).tolist(),
+        "benchmark": np.round(benchmark_returns, 2).tolist(),
+        "values": np.round(values, 2).tolist(),
+        "portfolio_return": round(float(portfolio_returns[-1]), 2),
+        "benchmark_return": round(float(benchmark_returns[-1]), 2),
+        "excess_return": round(float(portfolio_returns[-1] - benchmark_returns[-1]), 2),
+    }
@@ -0,0 +1,93 @@
+import argparse
+import asyncio
+import sys
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from bson import ObjectId
+
+from ..database import close_connection, db, ensure_indexes
+from .cache import cache_entries
+from .cost_basis import cost_basis
+from .jobs import QUEUED, RUNNING, jobs
+from .snapshots import portfolio_snapshots
+from .user_search import search_query
+
+# Importing the owning modules also registers their indexes for --ensure.
+# Every query shape the request path issues, with placeholder values:
+# (label, collection, filter, sort). Keep in step with the routes and
+# services; a new query should be added here with its index.
+_user = ObjectId()
+_now = datetime.utcnow()
+QUERY_SHAPES: List[Tuple[str, object, Dict, Optional[List[Tuple[str, int]]]]] = [
+    ("user by id", db.users, {"_id": _user}, None),
+    ("user by username (signin/signup)", db.users, {"username": "audit"}, None),
+    ("user browser page", db.users, {"_id": {"$gt": _user}}, [("_id", 1)]),
+    ("user search page", db.users, {**search_query("audit"), "_id": {"$gt": _user}}, [("_id", 1)]),
+    ("trades page", db.trades, {"user_id": _user}, [("timestamp", -1), ("_id", -1)]),
+    ("trades page after cursor", db.trades,
+     {"user_id": _user, "$or": [{"timestamp": {"$lt": _now}}, {"timestamp": _now, "_id": {"$lt": ObjectId()}}]},
+     [("timestamp", -1), ("_id", -1)]),
+    ("trades page by symbol", db.trades, {"user_id": _user, "symbol": "AAPL"}, [("timestamp", -1), ("_id", -1)]),
+    ("trades page by kind and dates", db.trades,
+     {"user_id": _user, "option_type": {"$exists": True}, "timestamp": {"$gte": _now - timedelta(days=30), "$lt": _now}},
+     [("timestamp", -1), ("_id", -1)]),
+    ("ledger replay / export", db.trades, {"user_id": _user}, [("timestamp", 1), ("_id", 1)]),
+    ("portfolio history", portfolio_snapshots, {"user_id": str(_user), "date": {"$gte": "2025-01-01", "$lte": "2025-12-31"}},
+     [("date", 1)]),
+    ("cost basis by user", cost_basis, {"user_id": str(_user)}, None),
+    ("cost basis position", cost_basis, {"user_id": str(_user), "symbol": "AAPL"}, None),
+    ("insights by user", db.portfolio_insights, {"_id": str(_user)}, None),
+    ("job by id", jobs, {"_id": "audit"}, None),
+    ("job claim", jobs, {"$or": [{"status": QUEUED}, {"status": RUNNING, "started_at": {"$lt": _now}}]},
+     [("created_at", 1)]),
+    ("cache entries", cache_entries, {"_id": {"$in": ["audit:a", "audit:b"]}}, None),
+    ("sectors", db.sectors, {"_id": {"$in": ["AAPL", "MSFT"]}}, None),
+]
+
+
+def _stages(plan: Dict) -> Iterator[str]:
+    # Every stage name in a (possibly nested) plan tree
+    if "stage" in plan:
+        yield plan["stage"]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from _stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from _stages(child)
+
+
+async def audit() -> List[Tuple[str, str, bool]]:
+    # Returns (label, plan summary, collection scan?) per query shape
+    results = []
+    for label, collection, query, sort in QUERY_SHAPES:
+        cursor = collection.find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explained = await cursor.explain()
+        stages = list(_stages(explained["queryPlanner"]["winningPlan"]))
+        results.append((f"{collection.name}: {label}", " <- ".join(stages), "COLLSCAN" in stages))
+    return results
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description="Explain every route query shape and flag collection scans")
+    parser.add_argument("--ensure", action="store_true", help="Create the registered indexes first")
+    args = parser.parse_args()
+
+    try:
+        if args.ensure:
+            await ensure_indexes()
+        results = await audit()
+    finally:
+        await close_connection()
+
+    for label, plan, scan in results:
+        print(f"{'COLLSCAN' if scan else 'ok':8}  {label:55}  {plan}")
+    scans = sum(scan for _, _, scan in results)
+    print(f"{scans} of {len(results)} query shapes scan their collection")
+    sys.exit(1 if scans else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import math
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from pymongo.errors import DuplicateKeyError
+
+from ..database import held_symbols, locks
+from .quotes import SNAPSHOT_CHUNK_SIZE, quote_cache, refresh_quotes, request_counts, snapshot_supported
+
+logger = logging.getLogger(__name__)
+
+# Keeps the quotes users actually look at (held, watched, or frequently
+# requested) refreshed ahead of expiry, so dashboard reads are cache hits.
+# One worker holds a lease in Mongo and does the refreshing; the others pick
+# the results up from the shared cache tier.
+REFRESH_INTERVAL = float(os.getenv("QUOTE_REFRESH_INTERVAL", "30"))
+# Entries expiring within this window are refreshed on the current pass
+REFRESH_AHEAD = float(os.getenv("QUOTE_REFRESH_AHEAD", "60"))
+# How often the held/watched symbol set is re-read from Mongo
+HOT_SET_INTERVAL = float(os.getenv("QUOTE_HOT_SET_INTERVAL", "300"))
+HOT_SET_SIZE = int(os.getenv("QUOTE_HOT_SET_SIZE", "500"))
+# Upstream request budget for the refresher, leaving headroom for live traffic
+REFRESH_BUDGET_PER_MINUTE = float(os.getenv("QUOTE_REFRESH_BUDGET_PER_MINUTE", "60"))
+
+# A held symbol counts as this many requests when ranking the hot set
+HELD_WEIGHT = 10
+LEASE_TTL = timedelta(seconds=REFRESH_INTERVAL * 3)
+
+
+class TokenBucket:
+    # Continuous-refill rate limiter; capacity is one minute of budget
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def available(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def take(self, cost: float):
+        self.tokens -= cost
+
+
+def _symbols_per_request() -> int:
+    # One snapshot call covers a whole chunk; the per-symbol fallback covers one
+    return SNAPSHOT_CHUNK_SIZE if snapshot_supported() else 1
+
+
+class QuoteRefresher:
+    def __init__(self):
+        self.owner = uuid.uuid4().hex
+        self.budget = TokenBucket(REFRESH_BUDGET_PER_MINUTE)
+        self._held: List[str] = []
+        self._held_loaded_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "leader": False,
+            "cycles": 0,
+            "hot_set_size": 0,
+            "due": 0,
+            "refreshed": 0,
+            "deferred": 0,
+            "errors": 0,
+            "last_run_at": None,
+            "last_duration_ms": None,
+            "last_error": None,
+        }
+
+    async def _acquire_lease(self) -> bool:
+        # Take or renew the refresher lease; expired leases can be taken over
+        now = datetime.utcnow()
+        try:
+            await locks.find_one_and_update(
+                {"_id": "quote_refresher", "$or": [{"owner": self.owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": self.owner, "expires_at": now + LEASE_TTL}},
+                upsert=True,
+            )
+            return True
+        except DuplicateKeyError:
+            # Another worker holds a live lease
+            return False
+
+    async def _release_lease(self):
+        try:
+            await locks.delete_one({"_id": "quote_refresher", "owner": self.owner})
+        except Exception as e:
+            logger.warning(f"Could not release quote refresher lease: {e}")
+
+    async def hot_set(self) -> List[str]:
+        # Held and watched symbols plus the most requested ones, hottest first
+        if time.monotonic() - self._held_loaded_at > HOT_SET_INTERVAL:
+            self._held = await held_symbols()
+            self._held_loaded_at = time.monotonic()
+
+        weights: Dict[str, float] = dict(request_counts)
+        for symbol in self._held:
+            weights[symbol] = weights.get(symbol, 0) + HELD_WEIGHT
+        ranked = sorted(weights, key=weights.get, reverse=True)
+        return ranked[:HOT_SET_SIZE]
+
+    def _decay(self):
+        # Halve request counts each pass so the ranking follows recent demand
+        for symbol, count in list(request_counts.items()):
+            if count <= 1:
+                del request_counts[symbol]
+            else:
+                request_counts[symbol] = count // 2
+
+    async def run_once(self) -> int:
+        started = time.monotonic()
+        hot = await self.hot_set()
+
+        due = []
+        for symbol in hot:
+            expires_in = quote_cache.expires_in(symbol)
+            if expires_in is None or expires_in <= REFRESH_AHEAD:
+                due.append(symbol)
+
+        # Hottest symbols first, as many as the budget allows
+        per_request = _symbols_per_request()
+        batch = due[:int(self.budget.available()) * per_request]
+
+        refreshed = {}
+        if batch:
+            self.budget.take(math.ceil(len(batch) / per_request))
+            refreshed = await refresh_quotes(batch)
+
+        self.stats.update({
+            "cycles": self.stats["cycles"] + 1,
+            "hot_set_size": len(hot),
+            "due": len(due),
+            "refreshed": self.stats["refreshed"] + len(refreshed),
+            "deferred": self.stats["deferred"] + len(due) - len(batch),
+            "last_run_at": datetime.utcnow().isoformat(),
+            "last_duration_ms": round((time.monotonic() - started) * 1000, 1),
+        })
+        if batch:
+            logger.info(
+                f"Quote refresher: {len(refreshed)}/{len(batch)} refreshed, "
+                f"{len(due) - len(batch)} deferred, hot set {len(hot)}"
+            )
+        return len(refreshed)
+
+    async def _loop(self):
+        while True:
+            try:
+                self._decay()
+                self.stats["leader"] = await self._acquire_lease()
+                if self.stats["leader"]:
+                    await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["errors"] += 1
+                self.stats["last_error"] = str(e)
+                logger.warning(f"Quote refresher pass failed: {e}")
+            await asyncio.sleep(REFRESH_INTERVAL)
+
+    def start(self):
+        if REFRESH_BUDGET_PER_MINUTE <= 0 or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self.stats["leader"]:
+            await self._release_lease()
+
+
+quote_refresher = QuoteRefresher()
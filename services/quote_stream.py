@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import os
+from typing import Dict, Iterable, List, Optional, Set
+
+from .cache import normalize_symbol
+from .quotes import get_quotes
+
+logger = logging.getLogger(__name__)
+
+# Subscribed symbols are read through the quote cache on this interval, so
+# upstream sees at most one fetch per symbol per cache TTL however many
+# clients are watching it
+STREAM_POLL_INTERVAL = float(os.getenv("QUOTE_STREAM_POLL_INTERVAL", "5"))
+# Idle connections get a keep-alive at this interval so proxies don't drop them
+STREAM_HEARTBEAT = float(os.getenv("QUOTE_STREAM_HEARTBEAT", "25"))
+MAX_STREAM_SYMBOLS = int(os.getenv("QUOTE_STREAM_MAX_SYMBOLS", "100"))
+
+
+def _delta(previous: Optional[Dict], quote: Dict) -> Dict:
+    # Fields that changed since the last update (everything for a first update)
+    if previous is None:
+        return dict(quote)
+    return {key: value for key, value in quote.items() if previous.get(key) != value}
+
+
+class Subscription:
+    # One connected client. Pending updates are merged per symbol, so a slow
+    # client gets the latest values instead of a growing backlog, and an idle
+    # one costs a set, a dict and an event.
+    __slots__ = ("symbols", "pending", "event")
+
+    def __init__(self):
+        self.symbols: Set[str] = set()
+        self.pending: Dict[str, Dict] = {}
+        self.event = asyncio.Event()
+
+    def push(self, symbol: str, delta: Dict):
+        self.pending.setdefault(symbol, {}).update(delta)
+        self.event.set()
+
+    async def next_batch(self, timeout: float = STREAM_HEARTBEAT) -> Dict[str, Dict]:
+        # Waits for updates; an empty dict means the heartbeat interval passed
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return {}
+        self.event.clear()
+        batch, self.pending = self.pending, {}
+        return batch
+
+
+class QuoteHub:
+    # Fans quote updates out to every subscriber from a single poller per
+    # worker. The poller only runs while someone is subscribed.
+    def __init__(self):
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+        self._last: Dict[str, Dict] = {}
+        self._connections: Set[Subscription] = set()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"polls": 0, "updates_sent": 0, "errors": 0}
+
+    def connect(self) -> Subscription:
+        subscription = Subscription()
+        self._connections.add(subscription)
+        return subscription
+
+    def disconnect(self, subscription: Subscription):
+        self.unsubscribe(subscription, list(subscription.symbols))
+        self._connections.discard(subscription)
+
+    async def subscribe(self, subscription: Subscription, symbols: Iterable[str]) -> List[str]:
+        # Returns the symbols actually added; the client gets the latest known
+        # quote for each straight away
+        room = MAX_STREAM_SYMBOLS - len(subscription.symbols)
+        added = [
+            symbol for symbol in dict.fromkeys(normalize_symbol(s) for s in symbols if s and s.strip())
+            if symbol not in subscription.symbols
+        ][:max(room, 0)]
+
+        unseen = []
+        for symbol in added:
+            subscription.symbols.add(symbol)
+            self._subscribers.setdefault(symbol, set()).add(subscription)
+            if symbol in self._last:
+                subscription.push(symbol, self._last[symbol])
+            else:
+                unseen.append(symbol)
+
+        if unseen:
+            await self._poll(unseen)
+        self._ensure_poller()
+        return added
+
+    def unsubscribe(self, subscription: Subscription, symbols: Iterable[str]):
+        for symbol in symbols:
+            symbol = normalize_symbol(symbol)
+            subscription.symbols.discard(symbol)
+            subscription.pending.pop(symbol, None)
+            subscribers = self._subscribers.get(symbol)
+            if subscribers is None:
+                continue
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[symbol]
+                self._last.pop(symbol, None)
+
+    async def _poll(self, symbols: List[str]):
+        quotes = await get_quotes(symbols)
+        for symbol, quote in quotes.items():
+            delta = _delta(self._last.get(symbol), quote)
+            if not delta:
+                continue
+            self._last[symbol] = quote
+            for subscription in self._subscribers.get(symbol, ()):
+                subscription.push(symbol, delta)
+                self.stats["updates_sent"] += 1
+
+    async def _run(self):
+        try:
+            while self._subscribers:
+                await asyncio.sleep(STREAM_POLL_INTERVAL)
+                try:
+                    await self._poll(list(self._subscribers))
+                    self.stats["polls"] += 1
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    logger.warning(f"Quote stream poll failed: {e}")
+        finally:
+            self._task = None
+
+    def _ensure_poller(self):
+        if self._task is None and self._subscribers:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def snapshot_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "connections": len(self._connections),
+            "symbols": len(self._subscribers),
+        }
+
+
+quote_hub = QuoteHub()
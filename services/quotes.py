@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import os
+from collections import Counter
+from datetime import date, datetime
+from typing import Dict, Hashable, Iterable, List, Optional
+
+import httpx
+from fastapi import HTTPException
+
+from .cache import CoalescingCache, normalize_symbol, shared_backend
+from .market_calendar import (
+    DAILY_BAR_DELAY, MARKET_TZ, last_completed_session, next_close, previous_trading_day, seconds_until
+)
+from .market_data import polygon
+
+logger = logging.getLogger(__name__)
+
+# Expired quotes are still served for QUOTE_STALE_TTL seconds while one refresh runs
+QUOTE_STALE_TTL = int(os.getenv("QUOTE_STALE_TTL", "60"))
+QUOTE_CACHE_SIZE = int(os.getenv("QUOTE_CACHE_SIZE", "1000"))
+
+# Retry interval while upstream still serves the bar from before the latest close
+QUOTE_ROLLOVER_RETRY = int(os.getenv("QUOTE_ROLLOVER_RETRY", "1800"))
+
+
+def _quote_ttl(symbol: Hashable, quote: Dict) -> float:
+    # Quotes are previous-day bars, which can't change until the next session closes
+    now = datetime.now(MARKET_TZ)
+    trading_day = quote.get("tradingDay")
+    # A quote whose day is unknown may be the bar from before the latest
+    # close, so it gets the same short retry as one known to be behind
+    if not trading_day or date.fromisoformat(trading_day) < last_completed_session(now, DAILY_BAR_DELAY):
+        return QUOTE_ROLLOVER_RETRY
+    # i.e. until the next close whose bar will have been published
+    return seconds_until(next_close(now - DAILY_BAR_DELAY) + DAILY_BAR_DELAY, now)
+
+
+# Keys are normalized (" aapl" and "AAPL" share an entry) and shared across
+# workers through the L2 backend
+quote_cache = CoalescingCache(
+    "quotes",
+    maxsize=QUOTE_CACHE_SIZE,
+    ttl=300,
+    stale_ttl=QUOTE_STALE_TTL,
+    key_fn=normalize_symbol,
+    backend=shared_backend("quote"),
+    ttl_fn=_quote_ttl,
+)
+
+# Per-symbol fallback concurrency and snapshot request size
+QUOTE_FETCH_CONCURRENCY = int(os.getenv("QUOTE_FETCH_CONCURRENCY", "8"))
+SNAPSHOT_CHUNK_SIZE = 100
+
+# How often each symbol is asked for; feeds the background refresher's hot set
+request_counts: Counter = Counter()
+
+# Flipped off if the Polygon plan isn't entitled to the snapshot endpoint
+_snapshot_supported = True
+
+
+def _build_quote(symbol: str, bar: Dict, trading_day: Optional[str] = None) -> Dict:
+    # bar includes o, c, h, l, etc.; bars without t take the session date from trading_day
+    open_price = bar.get("o", 0)
+    close_price = bar.get("c", 0)
+    high_price = bar.get("h", 0)
+    low_price = bar.get("l", 0)
+
+    if open_price == 0:
+        # If open_price is zero, avoid division by zero in percentChange
+        raise HTTPException(status_code=500, detail="Invalid data: open price is zero.")
+
+    change = close_price - open_price
+    percentChange = (change / open_price) * 100
+
+    return {
+        "symbol": symbol.upper(),
+        "price": float(close_price),
+        "change": float(change),
+        "percentChange": float(percentChange),
+        "high": float(high_price),
+        "low": float(low_price),
+        "open": float(open_price),
+        "previousClose": float(open_price),  # Using open as a stand-in for previousClose
+        "name": symbol.upper(),
+        "currency": "USD",
+        "marketCap": 0,  # Not provided by this endpoint
+        "tradingDay": (
+            datetime.fromtimestamp(bar["t"] / 1000, MARKET_TZ).date().isoformat() if bar.get("t") else trading_day
+        )
+    }
+
+
+async def get_quote(symbol: str) -> Dict:
+    symbol = normalize_symbol(symbol)
+    request_counts[symbol] += 1
+    return await quote_cache.get_or_fetch(symbol, lambda: _fetch_quote(symbol))
+
+
+async def _fetch_quote(symbol: str) -> Dict:
+    try:
+        # Polygon previous day's aggregates endpoint:
+        # GET /v2/aggs/ticker/{symbol}/prev?adjusted=true
+        url = f"/v2/aggs/ticker/{symbol.upper()}/prev"
+        params = {
+            "adjusted": "true"
+        }
+        response = await polygon.get(url, params=params)
+
+        # Handle no data scenario (404 or empty results)
+        if response.status_code == 404:
+            raise HTTPException(status_code=404, detail="No data found for this symbol.")
+
+        response.raise_for_status()
+        data = response.json()
+
+        results = data.get("results", [])
+        if not results:
+            # No results returned
+            raise HTTPException(status_code=404, detail="No previous trading day data found.")
+
+        # The endpoint returns an array of one aggregate bar representing the previous trading day
+        return _build_quote(symbol, results[0])
+
+    except httpx.HTTPStatusError as e:
+        print(f"Polygon API Error for quote: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to fetch quote data: {str(e)}"
+        )
+    except Exception as e:
+        print(f"Unexpected Error in quote: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"An unexpected error occurred: {str(e)}"
+        )
+
+
+def _prev_day(item: Dict) -> Optional[str]:
+    # prevDay carries no timestamp. It is the session before the ticker's
+    # current day (which only rolls forward at the overnight reset), and
+    # "updated" (nanoseconds) falls on that current day.
+    updated = item.get("updated")
+    if not updated:
+        return None
+    current = datetime.fromtimestamp(updated / 1e9, MARKET_TZ).date()
+    return previous_trading_day(current).isoformat()
+
+
+async def _fetch_snapshot(symbols: List[str]) -> Dict[str, Dict]:
+    # One snapshot call returns the previous-day bar for many tickers at once
+    global _snapshot_supported
+    found: Dict[str, Dict] = {}
+    if not _snapshot_supported:
+        return found
+
+    by_ticker = {symbol.upper(): symbol for symbol in symbols}
+    tickers = list(by_ticker)
+    for i in range(0, len(tickers), SNAPSHOT_CHUNK_SIZE):
+        chunk = tickers[i:i + SNAPSHOT_CHUNK_SIZE]
+        response = await polygon.get(
+            "/v2/snapshot/locale/us/markets/stocks/tickers",
+            params={"tickers": ",".join(chunk)},
+        )
+        if response.status_code in (401, 403):
+            logger.info("Polygon snapshot endpoint unavailable, using per-symbol quotes")
+            _snapshot_supported = False
+            return found
+        response.raise_for_status()
+
+        for item in response.json().get("tickers", []) or []:
+            symbol = by_ticker.get(item.get("ticker"))
+            bar = item.get("prevDay") or {}
+            if symbol is None or not bar.get("o"):
+                continue
+            found[symbol] = _build_quote(symbol, bar, _prev_day(item))
+
+    return found
+
+
+async def _fetch_quotes(symbols: List[str]) -> Dict[str, Dict]:
+    try:
+        quotes = await _fetch_snapshot(symbols)
+    except Exception as e:
+        logger.warning(f"Snapshot quote fetch failed, falling back to per-symbol: {e}")
+        quotes = {}
+
+    remaining = [symbol for symbol in symbols if symbol not in quotes]
+    if remaining:
+        semaphore = asyncio.Semaphore(QUOTE_FETCH_CONCURRENCY)
+
+        async def fetch_one(symbol: str):
+            async with semaphore:
+                try:
+                    quotes[symbol] = await _fetch_quote(symbol)
+                except HTTPException as e:
+                    print(f"Error fetching quote for {symbol}: {e.detail}")
+
+        await asyncio.gather(*(fetch_one(symbol) for symbol in remaining))
+
+    return quotes
+
+
+async def get_quotes(symbols: Iterable[str]) -> Dict[str, Dict]:
+    # Returns {symbol: quote} keyed by the symbols as passed in; symbols with no
+    # data are left out. Cache hits are served directly and all misses go
+    # upstream in one batch.
+    symbols = list(symbols)
+    request_counts.update(normalize_symbol(symbol) for symbol in symbols)
+    return await quote_cache.get_many(symbols, _fetch_quotes)
+
+
+def snapshot_supported() -> bool:
+    return _snapshot_supported
+
+
+async def refresh_quotes(symbols: Iterable[str]) -> Dict[str, Dict]:
+    # Refetches the symbols in one batch even if cached, writing through to both tiers
+    return await quote_cache.refresh(symbols, _fetch_quotes)
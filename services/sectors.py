@@ -0,0 +1,165 @@
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Set
+
+import yfinance as yf
+from cachetools import TTLCache
+from pymongo import UpdateOne
+
+from ..database import close_connection, db, held_symbols
+from .cache import normalize_symbol
+
+logger = logging.getLogger(__name__)
+
+# Persistent symbol -> sector table: {_id: SYMBOL, sector, industry, fetched_at, failed}
+sectors = db.sectors
+
+# Classifications rarely change; failed lookups are retried sooner
+SECTOR_MAX_AGE = timedelta(days=int(os.getenv("SECTOR_MAX_AGE_DAYS", "30")))
+SECTOR_FAILED_MAX_AGE = timedelta(days=1)
+SECTOR_FETCH_CONCURRENCY = int(os.getenv("SECTOR_FETCH_CONCURRENCY", "4"))
+
+# In-process copy so repeat lookups don't touch Mongo at all
+_sector_memo = TTLCache(maxsize=5000, ttl=3600)
+_refreshing: Set[str] = set()
+_tasks: Set[asyncio.Task] = set()
+
+
+def _fetch_profile(symbol: str) -> Dict:
+    # yfinance scrapes Yahoo synchronously, so this always runs in a thread
+    try:
+        info = yf.Ticker(symbol).info
+        return {
+            "sector": info.get('sector', 'Other') or 'Other',
+            "industry": info.get('industry'),
+            "failed": False,
+        }
+    except Exception as e:
+        logger.warning(f"Sector lookup failed for {symbol}: {e}")
+        return {"sector": 'Other', "industry": None, "failed": True}
+
+
+def _is_stale(doc: Dict, now: datetime) -> bool:
+    max_age = SECTOR_FAILED_MAX_AGE if doc.get("failed") else SECTOR_MAX_AGE
+    return now - doc["fetched_at"] > max_age
+
+
+async def refresh_sectors(symbols: List[str]) -> Dict[str, Dict]:
+    # Looks the symbols up upstream with bounded concurrency and upserts them
+    semaphore = asyncio.Semaphore(SECTOR_FETCH_CONCURRENCY)
+
+    async def fetch(symbol: str):
+        async with semaphore:
+            return symbol, await asyncio.to_thread(_fetch_profile, symbol)
+
+    now = datetime.utcnow()
+    profiles = await asyncio.gather(*(fetch(symbol) for symbol in symbols))
+    docs = {symbol: {**profile, "fetched_at": now} for symbol, profile in profiles}
+    if docs:
+        await sectors.bulk_write(
+            [UpdateOne({"_id": symbol}, {"$set": doc}, upsert=True) for symbol, doc in docs.items()],
+            ordered=False,
+        )
+    for symbol, doc in docs.items():
+        _sector_memo[symbol] = doc["sector"]
+    return docs
+
+
+def _refresh_in_background(symbols: List[str]):
+    symbols = [symbol for symbol in symbols if symbol not in _refreshing]
+    if not symbols:
+        return
+    _refreshing.update(symbols)
+
+    async def run():
+        try:
+            await refresh_sectors(symbols)
+        except Exception as e:
+            logger.warning(f"Background sector refresh failed: {e}")
+        finally:
+            _refreshing.difference_update(symbols)
+
+    task = asyncio.create_task(run())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def get_sectors(symbols: Iterable[str]) -> Dict[str, str]:
+    # Returns {symbol: sector} keyed by the symbols as passed in. Known symbols
+    # come from one batched read; stale ones are served and refreshed in the
+    # background, and only never-seen symbols are looked up inline.
+    originals: Dict[str, List[str]] = {}
+    for symbol in symbols:
+        originals.setdefault(normalize_symbol(symbol), []).append(symbol)
+
+    found: Dict[str, str] = {}
+    lookup = []
+    for symbol in originals:
+        if symbol in _sector_memo:
+            found[symbol] = _sector_memo[symbol]
+        else:
+            lookup.append(symbol)
+
+    if lookup:
+        now = datetime.utcnow()
+        stale = []
+        async for doc in sectors.find({"_id": {"$in": lookup}}, {"sector": 1, "fetched_at": 1, "failed": 1}):
+            found[doc["_id"]] = doc["sector"]
+            if _is_stale(doc, now):
+                stale.append(doc["_id"])
+            else:
+                _sector_memo[doc["_id"]] = doc["sector"]
+
+        if stale:
+            _refresh_in_background(stale)
+
+        unknown = [symbol for symbol in lookup if symbol not in found]
+        if unknown:
+            for symbol, doc in (await refresh_sectors(unknown)).items():
+                found[symbol] = doc["sector"]
+
+    return {
+        original: found.get(symbol, 'Other')
+        for symbol, names in originals.items()
+        for original in names
+    }
+
+
+async def warm_sectors(symbols: Iterable[str] = None, force: bool = False) -> int:
+    # Bulk warm-up: by default every symbol held or watched by any user.
+    # Only unknown or stale symbols are fetched unless force is set.
+    if symbols is None:
+        symbols = await held_symbols()
+    wanted = list(dict.fromkeys(normalize_symbol(symbol) for symbol in symbols))
+
+    if not force:
+        now = datetime.utcnow()
+        fresh = set()
+        async for doc in sectors.find({"_id": {"$in": wanted}}, {"fetched_at": 1, "failed": 1}):
+            if not _is_stale(doc, now):
+                fresh.add(doc["_id"])
+        wanted = [symbol for symbol in wanted if symbol not in fresh]
+
+    if wanted:
+        await refresh_sectors(wanted)
+    return len(wanted)
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description="Warm the symbol -> sector classification store")
+    parser.add_argument("symbols", nargs="*", help="symbols to warm (default: every held or watched symbol)")
+    parser.add_argument("--force", action="store_true", help="refetch even if the stored entry is fresh")
+    args = parser.parse_args()
+
+    try:
+        refreshed = await warm_sectors(args.symbols or None, force=args.force)
+        print(f"Refreshed {refreshed} sector entries")
+    finally:
+        await close_connection()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
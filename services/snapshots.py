@@ -0,0 +1,223 @@
+import argparse
+import asyncio
+import logging
+import os
+import uuid
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import ASCENDING, IndexModel, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from ..database import close_connection, db, ensure_indexes, locks, register_indexes, users
+from .bars import bar_dates, daily_bars
+from .market_calendar import DAILY_BAR_DELAY, MARKET_TZ, last_completed_session, next_close, seconds_until
+from .quotes import get_quotes, refresh_quotes
+
+logger = logging.getLogger(__name__)
+
+# One document per user per trading day: {user_id, date: "YYYY-MM-DD", value,
+# cash, positions_value, created_at}, unique on (user_id, date)
+portfolio_snapshots = db.portfolio_snapshots
+register_indexes("portfolio_snapshots", IndexModel([("user_id", ASCENDING), ("date", ASCENDING)], unique=True))
+
+# Users are valued in batches so each batch needs one quote lookup
+SNAPSHOT_BATCH_SIZE = int(os.getenv("SNAPSHOT_BATCH_SIZE", "500"))
+# A run that hasn't finished after this long may be taken over by another worker
+SNAPSHOT_LEASE = timedelta(minutes=int(os.getenv("SNAPSHOT_LEASE_MINUTES", "30")))
+# Runs this long after the close, once the session's closing quotes are published
+SNAPSHOT_DELAY = DAILY_BAR_DELAY + timedelta(minutes=5)
+# Users holding a symbol whose quote is missing or hasn't rolled over to the
+# day yet are retried this often, up to SNAPSHOT_MAX_RETRIES times; the last
+# run values what is still behind at its last close so a halted symbol can't
+# hold a user's history up for good
+SNAPSHOT_RETRY = timedelta(minutes=int(os.getenv("SNAPSHOT_RETRY_MINUTES", "15")))
+SNAPSHOT_MAX_RETRIES = int(os.getenv("SNAPSHOT_MAX_RETRIES", "8"))
+
+_worker_id = uuid.uuid4().hex
+
+
+async def _last_closes(symbols: List[str], day: str) -> Dict[str, Dict]:
+    # Quote-shaped {"price": close} from the bar store's last bar on or
+    # before the day, for symbols with no quote at all
+    closes: Dict[str, Dict] = {}
+    for symbol in symbols:
+        try:
+            bars = await daily_bars.sync(symbol, date.fromisoformat(day))
+        except Exception as e:
+            logger.warning(f"No closing price for {symbol}: {e}")
+            continue
+        bars = bars[bar_dates(bars) <= date.fromisoformat(day)]
+        if len(bars):
+            closes[symbol] = {"price": float(bars["c"][-1])}
+    return closes
+
+
+async def _snapshot_batch(batch: List[Dict], day: str, final: bool = False) -> Tuple[int, int]:
+    # Returns (stored, deferred). Missing quotes and quotes still on an
+    # earlier session are refetched once; users holding a symbol that is
+    # still behind are left for a later run rather than stored with a wrong
+    # value. On the final run those symbols are valued at their last close
+    # instead, and only users with a symbol that has no price at all are
+    # skipped for the day.
+    symbols = {
+        symbol
+        for user in batch
+        for symbol, quantity in user.get("portfolio", {}).items()
+        if quantity > 0
+    }
+    quotes = await get_quotes(symbols)
+    behind = [symbol for symbol in symbols if quotes.get(symbol, {}).get("tradingDay") != day]
+    if behind:
+        quotes.update(await refresh_quotes(behind))
+    if final:
+        quotes.update(await _last_closes([symbol for symbol in symbols if symbol not in quotes], day))
+        behind = {symbol for symbol in symbols if symbol not in quotes}
+    else:
+        behind = {symbol for symbol in symbols if quotes.get(symbol, {}).get("tradingDay") != day}
+
+    now = datetime.utcnow()
+    ops = []
+    deferred = 0
+    for user in batch:
+        held = [symbol for symbol, quantity in user.get("portfolio", {}).items() if quantity > 0]
+        if any(symbol in behind for symbol in held):
+            deferred += 1
+            continue
+        cash = float(user.get("cash", 0) or 0)
+        positions_value = sum(
+            quantity * quotes[symbol]["price"]
+            for symbol, quantity in user.get("portfolio", {}).items()
+            if quantity > 0
+        )
+        ops.append(UpdateOne(
+            {"user_id": str(user["_id"]), "date": day},
+            {"$set": {
+                "value": cash + positions_value,
+                "cash": cash,
+                "positions_value": positions_value,
+                "created_at": now,
+            }},
+            upsert=True,
+        ))
+    if ops:
+        await portfolio_snapshots.bulk_write(ops, ordered=False)
+    if final and deferred:
+        logger.warning(f"Skipped {deferred} portfolio snapshots for {day}: no price for {sorted(behind)}")
+        deferred = 0
+    return len(ops), deferred
+
+
+async def take_snapshots(final: bool = False) -> Tuple[int, int]:
+    # Values every user's portfolio at the last completed session's close.
+    # Quotes are the session's closing prices, so only that day can be
+    # recorded; re-running it overwrites its snapshots. Returns (stored,
+    # deferred), where deferred users need another run once quotes roll
+    # over; a final run never defers.
+    day = last_completed_session(grace=SNAPSHOT_DELAY).isoformat()
+    count = deferred = 0
+    batch: List[Dict] = []
+    async for user in users.find({}, {"portfolio": 1, "cash": 1}):
+        batch.append(user)
+        if len(batch) >= SNAPSHOT_BATCH_SIZE:
+            stored, waiting = await _snapshot_batch(batch, day, final)
+            count, deferred = count + stored, deferred + waiting
+            batch = []
+    if batch:
+        stored, waiting = await _snapshot_batch(batch, day, final)
+        count, deferred = count + stored, deferred + waiting
+    logger.info(f"Stored {count} portfolio snapshots for {day}, {deferred} waiting on quotes")
+    return count, deferred
+
+
+async def _claim_day(day: str) -> bool:
+    # First worker to claim a day runs it; unfinished runs can be taken over
+    now = datetime.utcnow()
+    lock_id = f"portfolio_snapshots:{day}"
+    try:
+        await locks.insert_one({"_id": lock_id, "owner": _worker_id, "started_at": now, "done": False})
+        return True
+    except DuplicateKeyError:
+        result = await locks.update_one(
+            {"_id": lock_id, "done": False, "started_at": {"$lt": now - SNAPSHOT_LEASE}},
+            {"$set": {"owner": _worker_id, "started_at": now}},
+        )
+        return result.modified_count == 1
+
+
+async def _run_scheduled():
+    # Catches up on the latest session at startup, then runs after each close
+    while True:
+        day = last_completed_session(grace=SNAPSHOT_DELAY).isoformat()
+        try:
+            if await _claim_day(day):
+                lock = await locks.find_one({"_id": f"portfolio_snapshots:{day}"}, {"retries": 1})
+                _, deferred = await take_snapshots(final=(lock or {}).get("retries", 0) >= SNAPSHOT_MAX_RETRIES)
+                if deferred:
+                    # Not done: release the claim so this or another worker
+                    # runs the day again once quotes have rolled over
+                    await locks.update_one(
+                        {"_id": f"portfolio_snapshots:{day}"},
+                        {"$set": {"started_at": datetime.utcnow() - SNAPSHOT_LEASE}, "$inc": {"retries": 1}},
+                    )
+                    await asyncio.sleep(SNAPSHOT_RETRY.total_seconds())
+                    continue
+                await locks.update_one({"_id": f"portfolio_snapshots:{day}"}, {"$set": {"done": True}})
+        except Exception as e:
+            logger.warning(f"Portfolio snapshot run for {day} failed: {e}")
+            # Let the lease lapse and try again later
+            await asyncio.sleep(SNAPSHOT_LEASE.total_seconds())
+            continue
+        now = datetime.now(MARKET_TZ)
+        await asyncio.sleep(seconds_until(next_close(now - SNAPSHOT_DELAY) + SNAPSHOT_DELAY, now) + 1)
+
+
+class SnapshotScheduler:
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(_run_scheduled())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+snapshot_scheduler = SnapshotScheduler()
+
+
+async def get_history(user_id: str, start: Optional[str] = None, end: Optional[str] = None) -> List[Dict]:
+    # Snapshots for one user in date order, optionally limited to [start, end]
+    query: Dict = {"user_id": user_id}
+    if start or end:
+        query["date"] = {}
+        if start:
+            query["date"]["$gte"] = start
+        if end:
+            query["date"]["$lte"] = end
+    cursor = portfolio_snapshots.find(query, {"_id": 0, "date": 1, "value": 1}).sort("date", ASCENDING)
+    return await cursor.to_list(length=None)
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description="Store the last completed session's portfolio value for every user")
+    parser.add_argument("--final", action="store_true", help="Value symbols still behind at their last close instead of waiting")
+    args = parser.parse_args()
+
+    try:
+        await ensure_indexes()
+        count, deferred = await take_snapshots(final=args.final)
+        print(f"Stored {count} portfolio snapshots, {deferred} users waiting on quotes for the day")
+    finally:
+        await close_connection()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
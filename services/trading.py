@@ -0,0 +1,208 @@
+import base64
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from fastapi import HTTPException
+from pymongo import DESCENDING, ReturnDocument
+
+from ..database import client, trades, users
+from .cache import normalize_symbol
+from .cost_basis import record_trade
+
+# Fields the transaction history shows
+TRADE_PROJECTION = {
+    "trade_type": 1, "symbol": 1, "quantity": 1, "price": 1, "total_cost": 1, "timestamp": 1,
+    "option_type": 1, "strike": 1, "premium": 1, "expiration": 1,
+}
+
+
+def option_holdings(user: Dict) -> Dict[str, float]:
+    # Contract key -> open quantity. The options map is written with $inc on
+    # "options.<contract>", and Mongo reads the dot in a float strike
+    # ("150.0") as a path separator, so contracts can be stored nested:
+    # {"AAPL-CALL-150": {"0-2024-01-19": 2}}. Joining the path back with dots
+    # restores the contract key the ledger uses.
+    holdings: Dict[str, float] = {}
+
+    def walk(node: Dict, prefix: str):
+        for key, value in node.items():
+            path = f"{prefix}.{key}" if prefix else key
+            if isinstance(value, dict):
+                walk(value, path)
+            elif isinstance(value, (int, float)) and value > 0:
+                holdings[path] = float(value)
+
+    walk(user.get("options") or {}, "")
+    return holdings
+
+
+class _GuardFailed(Exception):
+    # Raised inside the transaction when the update filter matched nothing
+    pass
+
+
+async def _apply_trade(user_id: str, position: str, guard: Dict, inc: Dict, ledger_doc: Dict, rejection: str) -> Dict:
+    # Applies the balance change only if the guard still holds, and writes
+    # the ledger entry and cost basis in the same transaction. Returns the
+    # updated user.
+    if ledger_doc["quantity"] <= 0 or ledger_doc["total_cost"] <= 0:
+        # A negative quantity or price would turn the guard around (a
+        # negative SELL debits cash unchecked, a negative BUY mints it)
+        raise HTTPException(status_code=400, detail="Quantity and price must be positive")
+    oid = ObjectId(user_id)
+    ledger_doc = {**ledger_doc, "user_id": oid, "timestamp": datetime.utcnow()}
+
+    async def run(session) -> Dict:
+        updated = await users.find_one_and_update(
+            {"_id": oid, **guard},
+            {"$inc": inc},
+            return_document=ReturnDocument.AFTER,
+            session=session,
+        )
+        if updated is None:
+            raise _GuardFailed()
+        # Retried transactions must not reuse an _id from an aborted attempt
+        ledger_doc.pop("_id", None)
+        await trades.insert_one(ledger_doc, session=session)
+        await record_trade(
+            user_id, position, ledger_doc["trade_type"], ledger_doc["quantity"], ledger_doc["total_cost"], session=session
+        )
+        return updated
+
+    try:
+        async with client.start_session() as session:
+            return await session.with_transaction(run)
+    except _GuardFailed:
+        # Only the failure path pays for a second read, to tell the cases apart
+        if not await users.find_one({"_id": oid}, {"_id": 1}):
+            raise HTTPException(status_code=404, detail="User not found")
+        raise HTTPException(status_code=400, detail=rejection)
+
+
+async def execute_stock(user_id: str, symbol: str, side: str, quantity: float, price: float) -> Dict:
+    # One spelling of the symbol for the portfolio key, ledger and cost basis,
+    # matching the transaction history's symbol filter
+    symbol = normalize_symbol(symbol)
+    total_cost = price * quantity
+    ledger_doc = {
+        "trade_type": side,
+        "symbol": symbol,
+        "quantity": quantity,
+        "price": price,
+        "total_cost": total_cost,
+    }
+    if side == "BUY":
+        return await _apply_trade(
+            user_id,
+            symbol,
+            {"cash": {"$gte": total_cost}},
+            {"cash": -total_cost, f"portfolio.{symbol}": quantity},
+            ledger_doc,
+            "Insufficient funds",
+        )
+    return await _apply_trade(
+        user_id,
+        symbol,
+        {f"portfolio.{symbol}": {"$gte": quantity}},
+        {"cash": total_cost, f"portfolio.{symbol}": -quantity},
+        ledger_doc,
+        "Insufficient shares",
+    )
+
+
+async def execute_option(
+    user_id: str,
+    symbol: str,
+    option_type: str,
+    strike: float,
+    expiration: str,
+    side: str,
+    quantity: int,
+    premium: float,
+) -> Dict:
+    symbol = normalize_symbol(symbol)
+    # Each contract is for 100 shares
+    total_cost = float(premium) * 100 * quantity
+    contract = f"{symbol}-{option_type}-{strike}-{expiration}"
+    position_key = f"options.{contract}"
+    ledger_doc = {
+        "trade_type": side,
+        "symbol": symbol,
+        "option_type": option_type,
+        "strike": strike,
+        "expiration": expiration,
+        "premium": premium,
+        "quantity": quantity,
+        "total_cost": total_cost,
+    }
+    if side == "BUY":
+        return await _apply_trade(
+            user_id,
+            contract,
+            {"cash": {"$gte": total_cost}},
+            {"cash": -total_cost, position_key: quantity},
+            ledger_doc,
+            "Insufficient funds",
+        )
+    return await _apply_trade(
+        user_id,
+        contract,
+        {position_key: {"$gte": quantity}},
+        {"cash": total_cost, position_key: -quantity},
+        ledger_doc,
+        "Insufficient contracts to sell",
+    )
+
+
+def encode_cursor(trade: Dict) -> str:
+    raw = f"{trade['timestamp'].isoformat()}|{trade['_id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+    try:
+        timestamp, oid = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(timestamp), ObjectId(oid)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def list_trades(
+    user_id: str,
+    symbol: Optional[str] = None,
+    kind: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = 10,
+) -> Tuple[List[Dict], Optional[str]]:
+    # One page of a user's trades, newest first. Pages continue from the
+    # (timestamp, _id) of the previous page's last trade, so each one is a
+    # bounded index scan however deep it is. Returns (trades, next cursor).
+    query: Dict = {"user_id": ObjectId(user_id)}
+    if symbol:
+        query["symbol"] = symbol
+    if kind:
+        query["option_type"] = {"$exists": kind == "option"}
+    if start or end:
+        query["timestamp"] = {}
+        if start:
+            query["timestamp"]["$gte"] = start
+        if end:
+            query["timestamp"]["$lt"] = end
+    if cursor:
+        timestamp, oid = decode_cursor(cursor)
+        query["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$lt": oid}},
+        ]
+
+    # One extra row tells whether there is a next page
+    page = await trades.find(query, TRADE_PROJECTION).sort(
+        [("timestamp", DESCENDING), ("_id", DESCENDING)]
+    ).limit(limit + 1).to_list(length=limit + 1)
+    if len(page) > limit:
+        page = page[:limit]
+        return page, encode_cursor(page[-1])
+    return page, None
@@ -0,0 +1,162 @@
+import argparse
+import asyncio
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi import HTTPException
+from pymongo import ASCENDING, IndexModel, UpdateOne
+
+from ..database import close_connection, ensure_indexes, register_indexes, users
+
+# Fields the user browser searches on
+SEARCH_FIELDS = ("username", "firstName", "lastName")
+# Searches with more matches than this report the cap as an estimate
+SEARCH_COUNT_CAP = int(os.getenv("SEARCH_COUNT_CAP", "1000"))
+SEARCH_BACKFILL_BATCH = 500
+
+# Each user stores the tokens of its searchable fields in search_tokens, kept
+# current on every write: every 1-, 2- and 3-letter substring of each word.
+# A search term's candidates are the users carrying all of its tokens (the
+# term itself when shorter than three letters, else its trigrams), found
+# through the index. Trigrams can match users that don't contain the term
+# ("abcd" and "abcxbcd" share every trigram), so candidates are confirmed
+# with a substring check before they are returned.
+register_indexes("users", IndexModel([("search_tokens", ASCENDING), ("_id", ASCENDING)]))
+
+_WORD = re.compile(r"[^\W_]+")
+
+
+def _words(text: str) -> List[str]:
+    return _WORD.findall(text.lower())
+
+
+def search_tokens(user: Dict) -> List[str]:
+    tokens = set()
+    for field in SEARCH_FIELDS:
+        for word in _words(str(user.get(field) or "")):
+            for n in (1, 2, 3):
+                tokens.update(f"g:{word[i:i + n]}" for i in range(len(word) - n + 1))
+    return sorted(tokens)
+
+
+def _query_tokens(search: str) -> List[str]:
+    # Every token a match must carry
+    tokens = set()
+    for term in _words(search):
+        if len(term) < 3:
+            tokens.add(f"g:{term}")
+        else:
+            tokens.update(f"g:{term[i:i + 3]}" for i in range(len(term) - 2))
+    return sorted(tokens)
+
+
+def search_query(search: Optional[str]) -> Dict:
+    tokens = _query_tokens(search or "")
+    return {"search_tokens": {"$all": tokens}} if tokens else {}
+
+
+async def token_update(user_id: str, changes: Dict) -> Dict:
+    # $set fields that keep search_tokens in step with a profile update;
+    # empty when no searchable field changes
+    if not any(field in changes for field in SEARCH_FIELDS):
+        return {}
+    current = await users.find_one({"_id": ObjectId(user_id)}, {field: 1 for field in SEARCH_FIELDS}) or {}
+    return {"search_tokens": search_tokens({**current, **changes})}
+
+
+def _matcher(search: str):
+    # Confirms a candidate: every term appears in one of the searchable fields
+    patterns = [re.compile(re.escape(term), re.IGNORECASE) for term in _words(search)]
+
+    def matches(user: Dict) -> bool:
+        values = [str(user.get(field) or "") for field in SEARCH_FIELDS]
+        return all(any(pattern.search(value) for value in values) for pattern in patterns)
+
+    return matches
+
+
+def decode_cursor(cursor: str) -> ObjectId:
+    try:
+        return ObjectId(cursor)
+    except (InvalidId, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def search_users(
+    search: Optional[str] = None, cursor: Optional[str] = None, limit: int = 20
+) -> Tuple[List[Dict], int, bool, Optional[str]]:
+    # One page of users in _id order, continuing after the cursor's _id.
+    # Returns (users, total, whether total is an estimate, next cursor).
+    query = search_query(search)
+    if search and not query:
+        # Nothing searchable in the term (only punctuation), so nothing matches
+        return [], 0, False, None
+    matches = _matcher(search) if query else (lambda user: True)
+
+    # Candidates are read in index order until a page (plus one, to know
+    # whether there is more) has been confirmed
+    page: List[Dict] = []
+    after = decode_cursor(cursor) if cursor else None
+    batch_size = max(limit * 2, 50)
+    while len(page) <= limit:
+        page_query = dict(query)
+        if after:
+            page_query["_id"] = {"$gt": after}
+        candidates = await users.find(page_query, {"password": 0, "search_tokens": 0}).sort(
+            "_id", ASCENDING
+        ).limit(batch_size).to_list(length=batch_size)
+        page.extend(user for user in candidates if matches(user))
+        if len(candidates) < batch_size:
+            break
+        after = candidates[-1]["_id"]
+
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = str(page[-1]["_id"])
+
+    if query:
+        # Counts candidates, which can include a few users the check above
+        # rejects, so it is always an estimate
+        total = await users.count_documents(query, limit=SEARCH_COUNT_CAP)
+        estimated = True
+    else:
+        # From collection metadata, no scan
+        total = await users.estimated_document_count()
+        estimated = True
+    return page, total, estimated, next_cursor
+
+
+async def backfill() -> int:
+    # Computes search_tokens for every existing user
+    count = 0
+    ops = []
+    async for user in users.find({}, {field: 1 for field in SEARCH_FIELDS}):
+        ops.append(UpdateOne({"_id": user["_id"]}, {"$set": {"search_tokens": search_tokens(user)}}))
+        if len(ops) >= SEARCH_BACKFILL_BATCH:
+            await users.bulk_write(ops, ordered=False)
+            count += len(ops)
+            ops = []
+    if ops:
+        await users.bulk_write(ops, ordered=False)
+        count += len(ops)
+    return count
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description="Build search tokens for existing users")
+    parser.parse_args()
+
+    try:
+        await ensure_indexes()
+        count = await backfill()
+        print(f"Indexed {count} users for search")
+    finally:
+        await close_connection()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())